@@ -0,0 +1,156 @@
+# event loop version of the control server.
+#
+# All the connections are served from one thread using asyncore, so an idle
+# client costs only a socket, not a thread. The protocol is the same as that
+# of the threaded server: one json bundle per line in, one json reply per line
+# out (or binary frames, see framing.py). The bundles are handed to handle_line
+# or handle_frame (see controlserver.py), which
+# posts the device functions to the channel workers and calls back with the reply.
+# The callback comes from a worker thread, so the reply is passed to the loop
+# thread through a trigger (a pipe which is watched by the loop).
+import asyncore
+import asynchat
+import socket
+import os
+import threading
+from collections import deque
+import framing
+
+class _Trigger(asyncore.file_dispatcher):
+    def __init__(self, map):
+        r, self._w = os.pipe()
+        asyncore.file_dispatcher.__init__(self, r, map)
+        self.lock, self.thunks = threading.Lock(), []
+    def readable(self): return True
+    def writable(self): return False
+    def pull_trigger(self, thunk):
+        # thunk is run in the loop thread.
+        with self.lock: self.thunks.append(thunk)
+        os.write(self._w, 'x')
+    def handle_read(self):
+        try: self.recv(8192)
+        except (socket.error, OSError): pass
+        with self.lock: thunks, self.thunks = self.thunks, []
+        for t in thunks: t()
+
+class _Line():
+    # a line pushed to a connection (an async_chat producer), sent() is called
+    # once it has been handed to the socket.
+    def __init__(self, data, sent): self.data, self.sent = data, sent
+    def more(self):
+        data, self.data = self.data, ''
+        if data == '': self.sent()
+        return data
+
+class _Connection(asynchat.async_chat):
+    max_pending, max_samples = 64, 16 # as the threaded server's Handler
+
+    def __init__(self, sock, addr, server):
+        asynchat.async_chat.__init__(self, sock, map=server.map)
+        self.set_terminator('\n')
+        self.server, self.client = server, addr
+        self.logger = server.new_logger(addr)
+        self.ibuf, self.lines, self.busy = [], deque(), False
+        self.subscription, self.nsamples = None, 0
+        self.npending = 0 # the bundles served whose replies haven't been sent.
+        self.framing = self.next_framing = None
+        self.frame_len = None # length of the binary frame being read.
+
+    def readable(self):
+        # a client which doesn't read its replies isn't served (nor read
+        # from) until they have been sent.
+        return self.npending < self.max_pending
+
+    def collect_incoming_data(self, data):
+        self.ibuf.append(data)
+
+    def found_terminator(self):
+        data, self.ibuf = ''.join(self.ibuf), []
+        if self.framing is None: self.lines.append((None, data+'\n'))
+        elif self.frame_len is None: # got the length, now read the frame.
+            self.frame_len = max(1, framing.frame_length(data))
+            self.set_terminator(self.frame_len)
+            return
+        else:
+            self.frame_len = None
+            self.set_terminator(4)
+            self.lines.append((self.framing, data))
+        self._next()
+
+    def _switch_framing(self):
+        # the framing command has been answered, the next request comes in
+        # the new framing.
+        if self.next_framing is self.framing: return
+        self.framing, self.frame_len = self.next_framing, None
+        if self.framing is None: self.set_terminator('\n')
+        else: self.set_terminator(4)
+
+    def _next(self):
+        # plain bundles of one connection are served one after another, as
+        # in the threaded server. The tagged ones (see handle_line) don't
+        # hold up the lines after them.
+        while not self.busy and len(self.lines) > 0 and self.npending < self.max_pending:
+            self.busy = True
+            self.npending += 1
+            st = {'waiting': True}
+            def reply(s, st=st):
+                self.server.trigger.pull_trigger(lambda: self._send_reply(s, st))
+            fr, data = self.lines.popleft()
+            if fr is None: rid = self.server.handle_line(data, self, reply)
+            else: rid = self.server.handle_frame(data, self, reply)
+            if rid is not None: st['waiting'], self.busy = False, False
+
+    def _send_reply(self, s, st):
+        if st['waiting']: self.busy = False
+        if not self.connected: return
+        self.push_with_producer(_Line(s, self._reply_sent))
+        self._switch_framing()
+        self._next()
+
+    # can be called from any thread, e.g. the poller pushing samples.
+    def sendline(self, s):
+        if not self.connected: raise socket.error('Connection closed')
+        self.server.trigger.pull_trigger(lambda: self._send_sample(s))
+
+    def _send_sample(self, s):
+        if not self.connected: return
+        if self.nsamples >= self.max_samples: return # the client is behind.
+        self.nsamples += 1
+        self.push_with_producer(_Line(s, self._sample_sent))
+
+    def _sample_sent(self): self.nsamples -= 1
+    def _reply_sent(self):
+        self.npending -= 1
+        self._next()
+
+    def send_samples(self, t, samples):
+        self.sendline(framing.encode_samples(self.framing, t, samples))
+
+    def handle_close(self):
+        self.logger.debug('Finish')
+        if self.subscription is not None: self.subscription.cancel()
+        self.close()
+
+class Server(asyncore.dispatcher):
+    allow_reuse_address = True
+
+    def __init__(self, server_address, handle_line, handle_frame, new_logger):
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map=self.map)
+        self.handle_line, self.handle_frame = handle_line, handle_frame
+        self.new_logger = new_logger
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        if self.allow_reuse_address: self.set_reuse_addr()
+        self.bind(server_address)
+        self.server_address = self.socket.getsockname()
+        self.listen(128)
+        self.trigger = _Trigger(self.map)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is None: return
+        _Connection(pair[0], pair[1], self)
+
+    def serve_forever(self):
+        # poll() instead of select(), to not be limited by FD_SETSIZE.
+        asyncore.loop(timeout=1.0, use_poll=True, map=self.map)
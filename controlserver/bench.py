@@ -0,0 +1,196 @@
+# benchmark of the control server, with the devices emulated (emulators.py).
+#
+#   python ./bench.py --clients 8 --duration 20 --mix mixed [--evloop] [--nopoll]
+# starts controlserver.py in a child process, with its serial ports on the
+# ptys of the emulators and a fake u6, and then the clients send bundles of
+# the mix, each as soon as it has the reply to its last one. The options not
+# known here are passed on to controlserver.py.
+# Reported are the latency of the bundles (p50/p99), the bundles per second,
+# and how busy each channel was (time its worker spent on the bus over the
+# length of the run, from the stats command). The runs are added to
+# log/bench/<git revision>.json, and
+#   python ./bench.py --compare
+# prints all the saved runs, for comparing them across commits.
+import os
+import sys
+import json
+import time
+import random
+import socket
+import threading
+import subprocess
+import devconfig
+
+here = os.path.dirname(os.path.abspath(__file__))
+resultdir = os.path.join(here, 'log', 'bench')
+address = ('127.0.0.1', 9999)
+
+# the bundles sent by the clients, mix: [(weight, function giving a bundle)].
+def _mixes():
+    devs = devconfig.devlist
+    reads = [{'dev': d, 'cmd': c, 'args': ['']}
+            for d in sorted(devs) for c in devs[d].get('poll', [])]
+    switches = [{'dev': d, 'cmd': 'get_state', 'args': ['']} for d in sorted(devs) if d[:3] == 'sw-']
+    mfcs = [d for d in sorted(devs) if d[:4] == 'mfc-']
+    ui = lambda: reads + switches # what the browser page asks for every second.
+    fresh = lambda: [dict(r, fresh=True) for r in reads]
+    def set_flow():
+        d = random.choice(mfcs)
+        fs = devs[d]['init_params']['fs_range']
+        return [{'dev': d, 'cmd': 'set_flow', 'args': ['%.1f'%(random.uniform(0, fs/2))]}]
+    return {'ui': [(1.0, ui)], 'fresh': [(1.0, fresh)], 'write': [(1.0, set_flow)],
+            'mixed': [(0.8, ui), (0.15, fresh), (0.05, set_flow)]}
+
+def _pick(mix):
+    x = random.uniform(0, sum(w for w, f in mix))
+    for w, f in mix:
+        x -= w
+        if x <= 0: break
+    return f()
+
+def _request(conn, bundle):
+    s, f = conn
+    s.sendall(json.dumps(bundle)+'\n')
+    return json.loads(f.readline())
+
+def _connect():
+    s = socket.create_connection(address)
+    return s, s.makefile()
+
+def client(mix, t_end, lat, errors):
+    conn = _connect()
+    while time.time() < t_end:
+        b = _pick(mix)
+        t0 = time.time()
+        try: res = _request(conn, b)
+        except (socket.error, ValueError):
+            errors.append('connection')
+            return
+        lat.append(time.time() - t0)
+        errors.extend(x['status'] for x in res if x.get('status') not in ('OK', 0))
+    conn[0].close()
+
+def percentile(xs, p):
+    # xs is sorted
+    if len(xs) == 0: return 0.0
+    return xs[min(len(xs)-1, int(p/100.0*len(xs)))]
+
+def revision():
+    try:
+        rev = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=here).strip()
+        if subprocess.call(['git', 'diff', '--quiet', 'HEAD'], cwd=here) != 0: rev += '-dirty'
+        return rev
+    except (OSError, subprocess.CalledProcessError): return 'unknown'
+
+# runs in the child process: the emulators, and the control server on them.
+def serve(server_args, rundir):
+    import emulators
+    devs = devconfig.devlist
+    tvc = emulators.TVC()
+    sierra = emulators.SierraMFC(fs_range=devs['mfc-n2-1']['init_params']['fs_range'])
+    brooks = emulators.BrooksBus([v['devid'] for v in devs.itervalues() if v['conn'] == 'rs485'])
+    for e in [tvc, sierra, brooks]: e.start()
+    sys.modules['u6'] = emulators.fake_u6(dict((v['devid'][1], v['devid'][2])
+            for v in devs.itervalues() if v['conn'] == 'labjack' and v['devid'][0] == 'AIO'))
+    import getport
+    getport.associate_ports = lambda: {'tvc': tvc.path, 'mfc-n2-1': sierra.path}
+    import rs485
+    port_open = rs485.port_open
+    rs485.port_open = lambda port=0, br=115200: port_open(brooks.path, br)
+    # the logs go to rundir/controlserver/log, not to the real ones.
+    os.chdir(os.path.join(rundir, 'cs'))
+    sys.argv = [os.path.join(here, 'controlserver.py')] + server_args
+    import runpy
+    runpy.run_path(sys.argv[0], run_name='__main__')
+
+def start_server(server_args):
+    import tempfile
+    rundir = tempfile.mkdtemp(prefix='bench-')
+    for d in ['cs', os.path.join('controlserver', 'log')]: os.makedirs(os.path.join(rundir, d))
+    out = open(os.path.join(rundir, 'server.txt'), 'w')
+    p = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', rundir] + server_args,
+            stdout=out, stderr=subprocess.STDOUT)
+    # wait till the devices have been initialised and it is listening.
+    t0 = time.time()
+    while time.time() - t0 < 60:
+        if p.poll() is not None: break
+        try:
+            socket.create_connection(address).close()
+            return p, rundir
+        except socket.error: time.sleep(0.2)
+    p.kill()
+    raise RuntimeError('Control server did not start, see '+os.path.join(rundir, 'server.txt'))
+
+def run(opts, server_args):
+    p, rundir = start_server(server_args)
+    try:
+        ctl = _connect()
+        time.sleep(opts.warmup)
+        _request(ctl, [{'dev': 'controller', 'cmd': 'stats', 'args': ['reset']}])
+        mix, lat, errors = _mixes()[opts.mix], [], []
+        t0 = time.time()
+        clients = [threading.Thread(target=client, args=(mix, t0+opts.duration, lat, errors))
+                for i in range(opts.clients)]
+        for c in clients: c.start()
+        for c in clients: c.join()
+        elapsed = time.time() - t0
+        stats = _request(ctl, [{'dev': 'controller', 'cmd': 'stats', 'args': ['']}])[0]['value']
+    finally:
+        p.terminate()
+        p.wait()
+    lat.sort()
+    ms = lambda x: round(x*1000, 2)
+    chans = {}
+    for c, s in stats['channels'].iteritems():
+        chans[c] = {'busy': round(s['count']*s['mean_ms']/1000.0/elapsed, 3),
+            'count': s['count'], 'mean_ms': s['mean_ms'], 'p99_ms': s['p99_ms'],
+            'wait_mean_ms': s['wait_mean_ms']}
+    return {'rev': revision(), 'time': time.time(), 'mix': opts.mix, 'clients': opts.clients,
+        'duration': round(elapsed, 2), 'server_args': server_args,
+        'bundles': len(lat), 'bundles_per_s': round(len(lat)/elapsed, 1),
+        'p50_ms': ms(percentile(lat, 50)), 'p99_ms': ms(percentile(lat, 99)),
+        'mean_ms': ms(sum(lat)/max(len(lat), 1)), 'max_ms': ms(lat[-1] if lat else 0),
+        'errors': len(errors), 'channels': chans, 'rundir': rundir}
+
+def show(r):
+    print '%-14s %-6s %3d clients %-18s %7.1f bundles/s  p50 %7.1f ms  p99 %7.1f ms  errors %d'%(
+            r['rev'], r['mix'], r['clients'], ' '.join(r['server_args']),
+            r['bundles_per_s'], r['p50_ms'], r['p99_ms'], r['errors'])
+
+def save(r):
+    if not os.path.isdir(resultdir): os.makedirs(resultdir)
+    fname = os.path.join(resultdir, r['rev']+'.json')
+    runs = json.load(open(fname)) if os.path.exists(fname) else []
+    with open(fname, 'w') as f: json.dump(runs + [r], f, indent=1)
+    return fname
+
+def compare():
+    runs = []
+    for fn in os.listdir(resultdir) if os.path.isdir(resultdir) else []:
+        if fn[-5:] == '.json': runs.extend(json.load(open(os.path.join(resultdir, fn))))
+    for r in sorted(runs, key=lambda r: r['time']): show(r)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--serve']:
+        serve(sys.argv[3:], sys.argv[2])
+        sys.exit(0)
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark of the control server with emulated devices.')
+    parser.add_argument('--clients', type=int, default=4, help='number of concurrent clients.')
+    parser.add_argument('--duration', type=float, default=10.0, help='length of the run in seconds.')
+    parser.add_argument('--mix', default='mixed', choices=sorted(_mixes().keys()),
+            help='the bundles sent by the clients.')
+    parser.add_argument('--warmup', type=float, default=1.0,
+            help='seconds to wait after the server has started, before the clients.')
+    parser.add_argument('--compare', action='store_true', help='print the saved runs and exit.')
+    opts, server_args = parser.parse_known_args()
+    if opts.compare:
+        compare()
+        sys.exit(0)
+    r = run(opts, server_args)
+    show(r)
+    for c, s in sorted(r['channels'].iteritems()):
+        print '    %-16s busy %5.1f%%  %6d cmds  mean %7.2f ms  p99 %5d ms  queue wait %7.2f ms'%(
+                c, s['busy']*100, s['count'], s['mean_ms'], s['p99_ms'], s['wait_mean_ms'])
+    print 'saved to', save(r)
@@ -0,0 +1,237 @@
+# the channel modules in processes of their own (controlserver.py --procs).
+#
+# Each module (rs232, rs485, labjack) is imported, opened and initialised in
+# a child process, which runs its devices' commands on one worker per
+# physical channel, as the server does without --procs (see dispatch.py).
+# So a blocking serial read or a LabJack reconnect holds the GIL of its own
+# process only, not that of the server handling the clients' json.
+#
+# The server sends (n, dev, cmd, args, prio) over a pipe to the process of
+# the device's module, and gets back the result of command n with the time
+# it waited for its channel and took on it (for stats.py).
+# The children poll their own devices (the 'poll' entries in devconfig) and
+# write the results into a Table in shared memory, which the server reads
+# through TablePoller, in place of poller.Poller.
+import os
+import sys
+import json
+import time
+import struct
+import logging
+import threading
+import itertools
+import traceback
+import multiprocessing
+import dispatch
+
+# a slot of the table: sequence number, time taken, length of the json of
+# [status, value], then the json. The sequence number is odd while the slot
+# is being written, the readers try again if it is odd or has changed while
+# they were reading (a seqlock, there is one writer per slot).
+_hdr = struct.Struct('<Idi')
+datasize = 240
+
+class Table():
+    def __init__(self, keys):
+        # keys are the (dev, cmd) polled, fixed when the table is made.
+        self.keys = list(keys)
+        self.index = dict((k, i) for i, k in enumerate(self.keys))
+        self.size = _hdr.size + datasize
+        self.buf = multiprocessing.RawArray('c', max(1, len(self.keys))*self.size)
+
+    def put(self, key, res, t):
+        o = self.index[key]*self.size
+        s = json.dumps(list(res))
+        if len(s) > datasize: s = json.dumps(['Error', ['Value too long for the table']])
+        seq = _hdr.unpack_from(self.buf, o)[0]
+        _hdr.pack_into(self.buf, o, seq+1, t, len(s))
+        self.buf[o+_hdr.size:o+_hdr.size+len(s)] = s
+        _hdr.pack_into(self.buf, o, seq+2, t, len(s))
+
+    def get(self, key, tries=100):
+        # returns (status, value, time taken), None if it hasn't been polled
+        # or the slot stays inconsistent (its process died while writing it),
+        # then the read goes to the device.
+        i = self.index.get(key)
+        if i is None: return None
+        o = self.size*i
+        for k in range(tries):
+            seq, t, n = _hdr.unpack_from(self.buf, o)
+            if seq == 0: return None
+            s = self.buf[o+_hdr.size:o+_hdr.size+n]
+            if seq%2 == 0 and _hdr.unpack_from(self.buf, o)[0] == seq: break
+        else: return None
+        try: status, value = json.loads(s)
+        except ValueError: return None
+        return status, value, t
+
+# the server side of a channel process.
+class Channel():
+    def __init__(self, conn, devs, devchan, polls, table, interval, stats):
+        # devs: {dev: devlist entry} of the devices of module conn.
+        self.conn, self.devchan, self.stats = conn, devchan, stats
+        self.lock, self.seq, self.futs = threading.Lock(), itertools.count(), {}
+        self.pipe, child = multiprocessing.Pipe()
+        self.proc = multiprocessing.Process(target=_child, name='chan-'+conn,
+                args=(conn, devs, devchan, polls, table, interval, child))
+        self.proc.daemon = True
+        self.proc.start()
+        child.close()
+        self.funcmap = None
+
+    def wait_ready(self):
+        # returns {dev: [commands]} once the devices have been initialised.
+        msg = self.pipe.recv()
+        if msg[0] != 'ready': raise RuntimeError('Channel process %s failed: %s'%(self.conn, msg[1]))
+        self.funcmap = msg[1]
+        t = threading.Thread(target=self._read, name='chan-'+self.conn)
+        t.daemon = True
+        t.start()
+        return self.funcmap
+
+    def submit(self, dev, cmd, args, prio):
+        f = dispatch.Future()
+        with self.lock:
+            n = next(self.seq)
+            self.futs[n] = (f, dev, cmd)
+            try: self.pipe.send((n, dev, cmd, args, prio))
+            except (IOError, OSError) as e:
+                del self.futs[n]
+                f.set_result(('Error', ['Channel process %s: %r'%(self.conn, e)]))
+        return f
+
+    def _read(self):
+        while True:
+            try: msg = self.pipe.recv()
+            except (EOFError, IOError): break
+            if msg[0] == 'res':
+                n, res, wait, dt = msg[1:]
+                with self.lock: f, dev, cmd = self.futs.pop(n)
+                self.stats.add(self.devchan[dev], (dev, cmd), wait, dt, dispatch.failed(res))
+                f.set_result(res)
+            elif msg[0] == 'stat':
+                dev, cmd, wait, dt, error = msg[1:]
+                self.stats.add(self.devchan[dev], (dev, cmd), wait, dt, error)
+        # the process has gone, so have the commands on it.
+        print 'Channel process %s has exited (%s)'%(self.conn, self.proc.exitcode)
+        with self.lock: futs, self.futs = self.futs, {}
+        for f, dev, cmd in futs.itervalues():
+            f.set_result(('Error', ['Channel process %s has exited'%(self.conn)]))
+
+# starts a process for each module having devices in devlist, returns
+# ({conn: Channel}, funcmap) once they have all been initialised. funcmap
+# has the names of the commands of each device (with None for the functions).
+def start(devlist, devchan, polls, table, interval, stats):
+    procs = {}
+    for conn in sorted(set(v['conn'] for v in devlist.itervalues())):
+        devs = dict((d, v) for d, v in devlist.iteritems() if v['conn'] == conn)
+        procs[conn] = Channel(conn, devs, devchan, [k for k in polls if k[0] in devs],
+                table, interval, stats)
+    funcmap = {}
+    for c in procs.itervalues():
+        for d, cmds in c.wait_ready().iteritems(): funcmap[d] = dict.fromkeys(cmds)
+    return procs, funcmap
+
+# records the queue wait and run time of the commands run by the child's
+# workers, they are sent to the server with the results.
+class _Timings():
+    def __init__(self):
+        self.lock, self.t = threading.Lock(), {}
+    def add(self, chan, tag, wait, dt, error):
+        with self.lock: self.t[tag] = (wait, dt)
+    def pop(self, tag):
+        with self.lock: return self.t.pop(tag, (0.0, 0.0))
+
+def _child(conn, devs, devchan, polls, table, interval, pipe):
+    # the server's log handler has no thread writing it out in here.
+    logging.getLogger().handlers = []
+    lock = threading.Lock()
+    def send(msg):
+        with lock: pipe.send(msg)
+    try:
+        mod = __import__(conn)
+        mod.init_comm()
+        funcmap = dict((d, mod.funcmap(d, v['devid'])) for d, v in devs.iteritems())
+        groups = {}
+        for d in sorted(devs):
+            if 'init_state' in funcmap[d]:
+                groups.setdefault(devchan[d], []).append(
+                        lambda d=d: funcmap[d]['init_state'](devs[d]['init_params']))
+        dispatch.run_parallel(groups.values())
+    except Exception as e:
+        traceback.print_exc()
+        send(('error', repr(e)))
+        sys.exit(1)
+    timings = _Timings()
+    workers = dict((c, dispatch.Executor(1, name=c, stats=timings))
+            for c in set(devchan[d] for d in devs))
+    send(('ready', dict((d, [c for c in f if c != 'handle']) for d, f in funcmap.iteritems())))
+
+    # the polls are tagged with their (dev, cmd), the clients' commands with n.
+    def poll():
+        while True:
+            t0 = time.time()
+            futs = [(k, workers[devchan[k[0]]].submit(funcmap[k[0]][k[1]], [''], k, dispatch.POLL))
+                    for k in polls]
+            for k, f in futs:
+                res = f.result()
+                table.put(k, res, time.time())
+                wait, dt = timings.pop(k)
+                send(('stat', k[0], k[1], wait, dt, dispatch.failed(res)))
+            time.sleep(max(0.0, interval - (time.time()-t0)))
+    if len(polls) > 0:
+        t = threading.Thread(target=poll, name='poller')
+        t.daemon = True
+        t.start()
+
+    def done(n, f):
+        wait, dt = timings.pop(n)
+        send(('res', n, f.result(), wait, dt))
+    # the other children have the server's ends of their pipes too, so the
+    # pipe isn't closed when the server is killed, its pid is watched instead.
+    ppid = os.getppid()
+    while True:
+        try:
+            if not pipe.poll(1.0):
+                if os.getppid() != ppid: os._exit(0)
+                continue
+            n, dev, cmd, args, prio = pipe.recv()
+        except (EOFError, IOError): os._exit(0) # the server has gone.
+        try: func = funcmap[dev][cmd]
+        except KeyError as e:
+            send(('res', n, ('Error', [repr(e)]), 0.0, 0.0))
+            continue
+        f = workers[devchan[dev]].submit(func, args, n, prio)
+        f.add_done_callback(lambda f, n=n: done(n, f))
+
+# used by the server in place of poller.Poller: the values are taken from the
+# table filled by the channel processes, and the listeners (subscriptions)
+# are called every interval.
+class TablePoller(threading.Thread):
+    def __init__(self, table, polls, interval, maxage):
+        threading.Thread.__init__(self, name='poller')
+        self.daemon = True
+        self.table, self.polls = table, polls
+        self.interval, self.maxage = interval, maxage
+        self.lock, self.listeners = threading.Lock(), []
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            now = time.time()
+            for cb in self.listeners[:]: cb(now)
+
+    def add_listener(self, cb):
+        with self.lock: self.listeners.append(cb)
+
+    def remove_listener(self, cb):
+        with self.lock:
+            if cb in self.listeners: self.listeners.remove(cb)
+
+    def get(self, dev, cmd):
+        # returns (status, value, age), or None if there is no recent value.
+        r = self.table.get((dev, cmd))
+        if r is None: return None
+        age = time.time() - r[2]
+        if age > self.maxage: return None
+        return r[0], r[1], age
@@ -1,110 +1,434 @@
 import logging
 import SocketServer
+import socket
+import collections
 import json
 import threading
-import os
+import time
 
 logging.basicConfig(level=logging.DEBUG, format='%(name)s, %(asctime)s: %(message)s')
+# the requests and replies (debug) go to the log file only, the console
+# would format and write each of them on the request thread.
+logging.getLogger().handlers[0].setLevel(logging.INFO)
 logdir = '../controlserver/log/'
 default_logfile = logdir+'log_controlserver.txt'
 default_logview = 'logview.txt' # this is the name of symlink.
 #handler = logging.handlers.RotatingFileHandler(log_filename, maxBytes=10*1024*1024, backupCount=10)
 
-def change_logfile(logger, f=default_logfile):
-    try:
-        logger.handlers[0].stream.close()
-        logger.removeHandler(logger.handlers[0])
-    except: pass
-    file_handler = logging.FileHandler(f)
-    file_handler.setLevel(logging.DEBUG)
-    formatter = logging.Formatter("%(name)s, %(asctime)s: %(message)s")
-    file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
-    # update the symlink to it.
-    try: os.unlink(default_logview)
-    except: pass
-    finally: os.symlink(f, default_logview)
-
-import rs232
-import rs485
-import labjack
-import test_ch
-
-chans = {'rs232':rs232, 'rs485':rs485, 'labjack':labjack, 'test_ch':test_ch}
-#chans = {'rs232':rs232, 'labjack':labjack, 'test_ch':test_ch}
-for k,v in chans.iteritems(): v.init_comm()
+# all the clients' requests and replies go to one log file, written from a
+# background thread (see logwriter.py). startnew/stoplog switch the file.
+import logwriter
+logfile = logwriter.LogWriter(default_logfile, default_logview)
+logfile.setLevel(logging.DEBUG)
+logfile.setFormatter(logging.Formatter("%(name)s, %(asctime)s: %(message)s"))
+logging.getLogger().addHandler(logfile)
+import atexit
+atexit.register(logfile.flush)
+
+# the command line is read before the channels are opened, as --procs
+# changes where they are opened.
+import argparse
+parser = argparse.ArgumentParser(description='Control server for the furnace.')
+parser.add_argument('--evloop', action='store_true',
+        help='serve all clients from one event loop instead of a thread per client.')
+parser.add_argument('--nopoll', action='store_true',
+        help='don\'t poll the devices in background, send every read to the device.')
+parser.add_argument('--procs', action='store_true',
+        help='run each channel module in a process of its own (see chanproc.py).')
+opts = parser.parse_args(None if __name__ == '__main__' else [])
 
+import dispatch
 import devconfig
-funcmap = {}
-for k, v in devconfig.devlist.iteritems():
-    funcmap[k] = chans[v['conn']].funcmap(k, v['devid'])
-# now funcmap has the functions available for each of the devices.
+
+# The rs232 module drives two serial ports (tvc and sierra mfc), the other
+# modules have all their devices on one bus.
+def channel_of(dev):
+    v = devconfig.devlist[dev]
+    if v['conn'] == 'rs232': return 'rs232:'+v['devid'][0]
+    return v['conn']
+
+import stats
+cmdstats = stats.Stats()
+devchan = dict((d, channel_of(d)) for d in devconfig.devlist.iterkeys())
+polls = [(d, c) for d, v in devconfig.devlist.iteritems() for c in v.get('poll', [])]
+
 print "\n\tReading configuration from devconfig.py and initialising the devices."
-for d in devconfig.devlist.iterkeys():
-    if 'init_state' in funcmap[d]: 
+t0 = time.time()
+if not opts.procs:
+    import rs232
+    import rs485
+    import labjack
+    import test_ch
+
+    chans = {'rs232':rs232, 'rs485':rs485, 'labjack':labjack, 'test_ch':test_ch}
+    #chans = {'rs232':rs232, 'labjack':labjack, 'test_ch':test_ch}
+    # the channels are opened at the same time.
+    dispatch.run_parallel([[v.init_comm] for v in chans.itervalues()])
+
+    funcmap = {}
+    for k, v in devconfig.devlist.iteritems():
+        funcmap[k] = chans[v['conn']].funcmap(k, v['devid'])
+    # now funcmap has the functions available for each of the devices.
+
+    # the channels are initialised at the same time, the devices of a channel
+    # one after another. The init_state functions write to a device only what
+    # differs from its init_params.
+    def init_state(d):
         print "initialising", d
         funcmap[d]['init_state'](devconfig.devlist[d]['init_params'])
+    groups = {}
+    for d in devconfig.devlist.iterkeys():
+        if 'init_state' in funcmap[d]:
+            groups.setdefault(devchan[d], []).append(lambda d=d: init_state(d))
+    dispatch.run_parallel(groups.values())
+
+    # one worker per physical channel, it runs the commands for the devices on
+    # that channel one by one, by their priority (see dispatch.PrioQueue).
+    workers, procs = {}, None
+    for c in set(devchan.itervalues()):
+        workers[c] = dispatch.Executor(1, name=c, stats=cmdstats)
+else:
+    # the modules are opened and initialised in their processes, which have
+    # the workers. funcmap here only has the names of the commands.
+    import chanproc
+    chans, workers = {}, {}
+    table = chanproc.Table(polls)
+    procs, funcmap = chanproc.start(devconfig.devlist, devchan, [] if opts.nopoll else polls,
+            table, devconfig.poll_interval, cmdstats)
 # generate the index.html (i.e. the UI seen in browser)
 #devconfig.gen_html_ui()
-print "\n\tDevice initialisation finished."
+print "\n\tDevice initialisation finished in %.1f s."%(time.time()-t0)
+
+# prio is the class of the command on its channel (see dispatch.PrioQueue),
+# by default the reads are dispatch.READ and the rest dispatch.ACTUATE. Reads
+# are shared only within a class, so a client's read doesn't wait behind the
+# poller's.
+inflight = dispatch.SingleFlight()
+def submit(dev, cmd, args, prio=None):
+    if prio is None: prio = dispatch.READ if dispatch.readonly(cmd) else dispatch.ACTUATE
+    if procs is None:
+        post = lambda: workers[devchan[dev]].submit(funcmap[dev][cmd], args, (dev, cmd), prio)
+    else:
+        funcmap[dev][cmd] # unknown devices and commands fail here, as above.
+        post = lambda: procs[devconfig.devlist[dev]['conn']].submit(dev, cmd, args, prio)
+    if not dispatch.readonly(cmd): return post()
+    return inflight.submit((dev, cmd, repr(args), prio), post)
+
+# the bus tracer (tracer.py) wraps these ports when it is turned on. The ports
+# aren't in this process with --procs.
+import tracer
+trace_slots = []
+if procs is None:
+    trace_slots = [('rs232:tvc', rs232.chan_d['tvc']), ('rs232:mfc-n2-1', rs232.chan_d['mfc-n2-1']),
+            ('rs485', rs485.chan_d), ('labjack', labjack.chan_d)]
+
+# the poller keeps the latest values of the reads listed in devconfig, it is
+# started from main. With --procs the channel processes poll, and the values
+# are read from their shared table.
+import poller
+if procs is None:
+    telemetry = poller.Poller(polls, submit, devconfig.poll_interval, devconfig.poll_maxage)
+else:
+    telemetry = chanproc.TablePoller(table, polls, devconfig.poll_interval, devconfig.poll_maxage)
+
+# tables for the binary framing, see framing.py.
+import framing
+_ctl_cmds = ['startnew', 'stoplog', 'subscribe', 'unsubscribe', 'framing', 'stats',
+        'trace_on', 'trace_off', 'trace_dump', 'reload_config']
+frames = framing.Framing(['controller'] + sorted(devconfig.devlist.keys()),
+        sorted(set(c for f in funcmap.itervalues() for c in f if c != 'handle')) + _ctl_cmds)
+# the same tables are used for recording the telemetry in binary (see logwriter.py).
+logfile.set_tables(frames)
+
+def new_logger(client_address):
+    logger = logging.getLogger(repr(client_address))
+    logger.debug('Started talking to '+str(client_address[0])+':'+
+            str(client_address[1])+' on '+threading.currentThread().getName())
+    return logger
+
+# the devlist which the running funcmap was made from, see reload_config.
+import copy
+running = copy.deepcopy(devconfig.devlist)
+reload_lock = threading.Lock()
 
-def get_response(l, devid, func, args):
-    l[devid] = func(args)
+# reads devconfig.py again and applies the changes, returns a Future of the
+# reply: new devices, and those whose conn or devid has changed, get new
+# handles. These, and the devices whose init_params have changed, are
+# initialised on their channel's worker (ahead of the reads). The other devices, and the ports and locks of the
+# channels, are left as they are. The polls and the poll timing are updated,
+# new devices and commands are added at the end of the framing tables.
+def reload_config():
+    global running, polls
+    if procs is not None: return 'Error', ['Not available with --procs, restart the server']
+    with reload_lock:
+        try: reload(devconfig)
+        except Exception as e: return 'Error', ['devconfig.py: '+repr(e)]
+        new = devconfig.devlist
+        for d, v in new.iteritems():
+            if v['conn'] not in chans: return 'Error', ['Unknown conn of '+d+': '+v['conn']]
+        added = sorted(d for d in new if d not in running)
+        removed = sorted(d for d in running if d not in new)
+        changed = sorted(d for d in new if d in running and
+                (new[d]['conn'], new[d]['devid']) != (running[d]['conn'], running[d]['devid']))
+        reinit = sorted(d for d in new if d in running and d not in changed and
+                new[d].get('init_params') != running[d].get('init_params'))
+        for d in removed:
+            del funcmap[d]
+            del devchan[d]
+        for d in added + changed:
+            funcmap[d] = chans[new[d]['conn']].funcmap(d, new[d]['devid'])
+            c = devchan[d] = channel_of(d)
+            if c not in workers: workers[c] = dispatch.Executor(1, name=c, stats=cmdstats)
+        futs = [(d, workers[devchan[d]].submit(funcmap[d]['init_state'], new[d]['init_params'],
+                (d, 'init_state'), dispatch.ACTUATE))
+                for d in added + changed + reinit if 'init_state' in funcmap[d]]
+        polls = [(d, cmd) for d, v in new.iteritems() for cmd in v.get('poll', [])]
+        telemetry.polls = polls
+        telemetry.interval, telemetry.maxage = devconfig.poll_interval, devconfig.poll_maxage
+        frames.extend(sorted(new.keys()), sorted(set(c for f in funcmap.itervalues() for c in f)))
+        logfile.set_tables(frames)
+        running = copy.deepcopy(new)
+    # the reply is given once the devices have been initialised, without
+    # holding up the caller (the event loop with --evloop).
+    res, done = {'added': added, 'removed': removed, 'changed': changed, 'reinitialised': reinit}, dispatch.Future()
+    def finish():
+        failed = [[d, f.result()[1]] for d, f in futs if dispatch.failed(f.result())]
+        if len(failed) > 0:
+            res['failed'] = failed
+            done.set_result(('Error', res))
+        else: done.set_result(('OK', res))
+    dispatch.when_all([f for d, f in futs], finish)
+    return done
 
+# stops pushing the samples to conn, if it had subscribed to them.
+def unsubscribe(conn):
+    if conn.subscription is not None: conn.subscription.cancel()
+    conn.subscription = None
+
+def controller_cmd(r, conn):
+    if r['cmd'] == 'startnew':
+        fname = r['args'][0]
+        # the file is opened here first, so a bad name gets an error reply.
+        try: open(logdir+fname, 'a').close()
+        except IOError as e: return 'Error', ['Cannot open the log file: '+repr(e)]
+        logfile.switch(logdir+fname)
+        print 'changing logfile to', fname
+    elif r['cmd'] == 'stoplog':
+        logfile.switch(default_logfile)
+        print 'changing logfile to default'
+    elif r['cmd'] == 'subscribe':
+        # e.g. {"dev": "controller", "cmd": "subscribe", "args": ["tvc", "mfc-h2-1"],
+        #       "interval": 1.0, "on_change": true}, empty args means all devices.
+        if not telemetry.is_alive(): return 'Error', 'Polling is turned off'
+        unsubscribe(conn)
+        devs = [x for x in r.get('args', []) if x != '']
+        conn.subscription = poller.Subscription(telemetry, devs,
+                float(r.get('interval', devconfig.poll_interval)),
+                bool(r.get('on_change', False)), conn.send_samples)
+    elif r['cmd'] == 'unsubscribe':
+        unsubscribe(conn)
+    elif r['cmd'] == 'framing':
+        # takes effect after the reply has been sent.
+        if r['args'][0] == 'binary':
+            conn.next_framing = frames
+            return 'OK', frames.tables()
+        elif r['args'][0] == 'json': conn.next_framing = None
+        else: return 'Error', 'Framing can be json|binary, given: '+r['args'][0]
+    elif r['cmd'] == 'stats':
+        # latency statistics per device command and per channel, see stats.py.
+        s = cmdstats.summary()
+        if 'reset' in r.get('args', []): cmdstats.reset()
+        return 'OK', s
+    elif r['cmd'][:6] == 'trace_' and procs is not None:
+        return 'Error', 'The ports are in the channel processes with --procs'
+    elif r['cmd'] == 'trace_on':
+        # args: [ring size], keeps the last 10000 transactions by default.
+        args = [x for x in r.get('args', []) if x != '']
+        tracer.enable(trace_slots, int(args[0]) if args else None)
+        return 'OK', 'Tracing, ring size %d'%(tracer.ring.maxlen)
+    elif r['cmd'] == 'reload_config':
+        return reload_config()
+    elif r['cmd'] == 'trace_off':
+        tracer.disable(trace_slots)
+    elif r['cmd'] == 'trace_dump':
+        # args: [file name in the log directory]
+        args = [x for x in r.get('args', []) if x != '']
+        fname = logdir+(args[0] if args else 'trace_%d.json'%(time.time()))
+        return 'OK', '%d transactions written to %s'%(tracer.dump(fname), fname)
+    return 'OK', ''
+
+# dispatches one line (a json bundle) from a client and calls reply() with
+# the reply once all the devices have responded, or the deadlines of those
+# which haven't have passed (see cmd_deadline in devconfig.py). reply may be
+# called from one of the channel workers. conn is the connection the line came
+# from, it has the logger, its framing, sendline()/send_samples() for pushing
+# to the client and its subscription.
+# A bundle can be tagged with an id, as {"id": 12, "bundle": [..]}, then the
+# reply is {"id": 12, "resp": [..]}. Tagged bundles are answered as soon as
+# they finish, so a client can have many of them going on one connection.
+# Returns the id, None for plain bundles (whose replies are kept in order).
+def handle_line(line, conn, reply):
+    rid, d = None, None
+    try:
+        d = json.loads(line)
+        if isinstance(d, dict):
+            # only the bundle is logged, so the logs stay the same for readlog.
+            rid, d = d['id'], d['bundle']
+            line = json.dumps(d)+'\n'
+    except Exception: pass
+    return handle_bundle(d, rid, line, conn, reply)
+
+# same as above for a binary request frame (see framing.py).
+def handle_frame(body, conn, reply):
+    rid, d, line = 0xffffffff, None, repr(body)
+    try:
+        rid, d = conn.framing.decode_request(body)
+        line = json.dumps(d)+'\n'
+    except Exception: pass
+    return handle_bundle(d, rid, line, conn, reply)
+
+# the json of x, made when the log record is formatted.
+class _Json():
+    def __init__(self, x): self.x = x
+    def __str__(self): return json.dumps(self.x)
+
+def handle_bundle(d, rid, line, conn, reply):
+    logger = conn.logger
+    logger.debug(line)
+    res, futs = [], []
+    def finish():
+        try:
+            for x, f in zip(res, futs):
+                x['status'], x['value'] = f.result()
+        except Exception as e:
+            res.append({'status':'Error', 'error': repr(e)+line})
+        logfile.record(res)
+        # the reply is encoded once, the log line of a binary reply is made
+        # by the log writer's thread.
+        if conn.framing is not None:
+            logger.debug('%s', _Json(res))
+            reply(conn.framing.encode_reply(rid, res))
+            return
+        s = json.dumps(res)
+        logger.debug(s)
+        if rid is not None: reply('{"id": %s, "resp": %s}\n'%(json.dumps(rid), s))
+        else: reply(s+'\n')
+    try:
+        if d is None: d = json.loads(line) # to report the parsing error.
+        for r in d:
+            x = {'dev':r['dev'], 'cmd':r['cmd']}
+            if r['dev'] == 'controller':
+                f = controller_cmd(r, conn)
+                if not isinstance(f, dispatch.Future): f = dispatch.done_future(f)
+                elif r.get('deadline') is not None: f = dispatch.with_deadline(f, float(r['deadline']))
+            else:
+                p = None
+                if not r.get('fresh', False): p = telemetry.get(r['dev'], r['cmd'])
+                if p is None:
+                    f = submit(r['dev'], r['cmd'], r['args'])
+                    dl = r.get('deadline', devconfig.cmd_deadline)
+                    if dl is not None: f = dispatch.with_deadline(f, float(dl))
+                else:
+                    f = dispatch.done_future(p[:2])
+                    x['age'] = round(p[2], 3)
+            res.append(x)
+            futs.append(f)
+    except Exception as e:
+        res.append({'status':'Error', 'error': repr(e)+line})
+    dispatch.when_all(futs, finish)
+    return rid
+
+# The replies and the subscribed samples are written to the client by a
+# writer thread of the connection, from its queue, so neither the channel
+# workers finishing a bundle nor the poller wait for a slow client. A
+# connection has at most max_pending bundles which haven't been written out,
+# then no more lines are read from it till the client takes its replies.
+# Samples are dropped when max_samples of them are waiting.
 class Handler(SocketServer.StreamRequestHandler):
+    max_pending, max_samples = 64, 16
+
     def __init__(self, request, client_address, server):
-        self.logger = logging.getLogger(repr(client_address))
+        self.logger = new_logger(client_address)
         self.client = client_address
         self.socket = request
         self.thread = threading.currentThread()
-        change_logfile(self.logger)
-        self.logger.debug('Started talking to '+str(self.client[0])+':'+
-                str(self.client[1])+' on '+self.thread.getName())
+        self.subscription = None
+        self.framing = self.next_framing = None
+        self.wcv, self.outq, self.nsamples = threading.Condition(), collections.deque(), 0
+        self.closed = False
+        self.pending = threading.Semaphore(self.max_pending)
         SocketServer.StreamRequestHandler.__init__(self, request, client_address, server)
         return
 
     def setup(self):
         self.logger.debug('Setup')
-        return SocketServer.StreamRequestHandler.setup(self)
+        r = SocketServer.StreamRequestHandler.setup(self)
+        self.writer = threading.Thread(target=self._write, name=self.thread.getName()+'-writer')
+        self.writer.daemon = True
+        self.writer.start()
+        return r
 
     def finish(self):
         self.logger.debug('Finish')
+        unsubscribe(self)
+        # the replies still queued are written before the socket is closed.
+        with self.wcv:
+            self.closed = True
+            self.wcv.notify()
+        self.writer.join(30.0)
         return SocketServer.StreamRequestHandler.finish(self)
 
+    def _write(self):
+        # after is called once s is written (or the client has gone).
+        dead = False
+        while True:
+            with self.wcv:
+                while len(self.outq) == 0 and not self.closed: self.wcv.wait()
+                if len(self.outq) == 0: return
+                s, after = self.outq.popleft()
+                if after is None: self.nsamples -= 1
+            if not dead:
+                try:
+                    self.wfile.write(s)
+                    self.wfile.flush()
+                except (socket.error, ValueError):
+                    dead = True
+                    with self.wcv: self.closed = True
+            if after is not None: after()
+
+    # can be called from any thread, doesn't wait for the write.
+    def sendline(self, s, after=None):
+        with self.wcv:
+            if self.closed: raise socket.error('Connection closed')
+            if after is None:
+                if self.nsamples >= self.max_samples: return # the client is behind.
+                self.nsamples += 1
+            self.outq.append((s, after))
+            self.wcv.notify()
+
+    def send_samples(self, t, samples):
+        self.sendline(framing.encode_samples(self.framing, t, samples))
+
     def handle(self):
         while True:          
-            line = self.rfile.readline()
-            self.logger.debug(line)
-            res = []
-            try:
-                d = json.loads(line)
-                t, resps = [], {}
-                for r in d:
-                    if r['dev'] == 'controller':
-                        if r['cmd'] == 'startnew':
-                            fname = r['args'][0]
-                            change_logfile(self.logger, logdir+fname)
-                            print 'changing logfile to', fname
-                        elif r['cmd'] == 'stoplog':
-                            change_logfile(self.logger)
-                            print 'changing logfile to default'
-                        res = d
-                        resps = {'controller':['OK', '']}
-                        continue
-                    func = funcmap[r['dev']][r['cmd']]
-                    res.append({'dev':r['dev'], 'cmd':r['cmd']})
-                    t.append(threading.Thread(target=get_response, args=(resps, r['dev'], func, r['args'])))
-                [x.start() for x in t]
-                [x.join() for x in t]
-                # now we have responses in resps, so
-                for i in range(len(res)):
-                    res[i]['status'] = resps[res[i]['dev']][0]
-                    res[i]['value'] = resps[res[i]['dev']][1]
-            except Exception as e:
-                res.append({'status':'Error', 'error': repr(e)+line})
-            finally:
-                self.logger.debug(json.dumps(res))
-                self.wfile.write(json.dumps(res)+'\n')
+            done = dispatch.Future()
+            def reply(s, done=done):
+                try: self.sendline(s, self.pending.release)
+                except socket.error: self.pending.release()
+                finally: done.set_result(None)
+            self.pending.acquire()
+            self.framing = self.next_framing
+            if self.framing is None:
+                line = self.rfile.readline()
+                if line == '': break # client has gone away.
+                rid = handle_line(line, self, reply)
+            else:
+                hdr = self.rfile.read(4)
+                if len(hdr) < 4: break
+                rid = handle_frame(self.rfile.read(framing.frame_length(hdr)), self, reply)
+            # tagged bundles are answered from the workers when they finish,
+            # for the plain ones we wait to keep the replies in order.
+            if rid is None: done.result()
         return
             
 
@@ -113,10 +437,11 @@ class multiServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
     pass
 
 if __name__ == '__main__':
-    import socket
-    import threading
+    if not opts.nopoll: telemetry.start()
 
-    server = multiServer(('0.0.0.0',9999), Handler)
+    if opts.evloop:
+        import asyncserver
+        server = asyncserver.Server(('0.0.0.0',9999), handle_line, handle_frame, new_logger)
+    else: server = multiServer(('0.0.0.0',9999), Handler)
     print '\n\tListening on:', server.server_address, ' for requests.'
     server.serve_forever()
-
@@ -20,7 +20,7 @@
 # In following: map= { devname: [channelname, idnumber] .. }
 
 _tvc = {
-    'conn': 'rs232', 'devid': ['tvc'], 
+    'conn': 'rs232', 'devid': ['tvc'], 'poll': ['get_pressure_position'],
     'init_params': {
         'manual-setp': 'Close', # this is the initial state
         'setpoints': [# name, mode, val, softstartval
@@ -46,7 +46,7 @@ _tvc = {
     }
 
 #_mfc_ch4_1 = {'conn':'rs485', 'devid':32, 'init_params': {'fs_range': 92.0, 'init_val': 0.0}}
-_mfc_ch4_2 = {'conn':'rs485', 'devid':33, 'init_params': {'fs_range': 10.0, 'init_val': 0.0}}
+_mfc_ch4_2 = {'conn':'rs485', 'devid':33, 'poll': ['get_flow'], 'init_params': {'fs_range': 10.0, 'init_val': 0.0}}
 
 # this is MKS analog MFC (1179). One more annlog MFC can use devid:[3:1]
 # For more analog MFCs, there are two LJTick-DAC in reserve. These can fit
@@ -54,10 +54,10 @@ _mfc_ch4_2 = {'conn':'rs485', 'devid':33, 'init_params': {'fs_range': 10.0, 'ini
 # This reduces the number of DIO lines to 16 from total available 20.
 # The DIO lines are used to control pneumatic switches, so number of switches
 # that can be controlled is reduced in that case. 
-_mfc_h2_2 = {'conn':'labjack', 'devid':['AIO', 3, 1], 'init_params': {'fs_range': 2000.0, 'init_val': 0.0}}
-_mfc_h2_1 = {'conn':'labjack', 'devid':['AIO', 2, 0], 'init_params': {'fs_range': 2000.0, 'init_val': 0.0}}
+_mfc_h2_2 = {'conn':'labjack', 'devid':['AIO', 3, 1], 'poll': ['get_flow'], 'init_params': {'fs_range': 2000.0, 'init_val': 0.0}}
+_mfc_h2_1 = {'conn':'labjack', 'devid':['AIO', 2, 0], 'poll': ['get_flow'], 'init_params': {'fs_range': 2000.0, 'init_val': 0.0}}
 
-_mfc_n2_1 = {'conn':'rs232', 'devid':['mfc-n2-1'], 'init_params': {'fs_range': 50.0, 'init_val': 1.0}}
+_mfc_n2_1 = {'conn':'rs232', 'devid':['mfc-n2-1'], 'poll': ['get_flow'], 'init_params': {'fs_range': 50.0, 'init_val': 1.0}}
 
 # On the relay board which controls the switches, there are 12 switches which
 # controlled by EIO/CIO (8/4) lines. EIO are addressed as digital I/O bits 8 
@@ -104,6 +104,23 @@ devlist = { 'tvc':_tvc,\
         'sw-ch4-2-by':_sw_ch4_2_by, 'sw-h2-1-in':_sw_h2_1_in,\
         'sw-h2-1-by':_sw_h2_1_by, 'sw-ventline':_sw_ventline,\
         'sw-n2-1-by':_sw_n2_1_by}
+
+# The commands in 'poll' entries above are run in background by the control
+# server every poll_interval seconds, and the clients asking for them get the
+# latest polled value (with its age in seconds) instead of going to the bus.
+# A polled value older than poll_maxage is not used. To get the value from
+# the device itself, add "fresh": true to the request, e.g.
+# {"dev": "tvc", "cmd": "get_pressure_position", "args": [""], "fresh": true}
+poll_interval = 0.4
+poll_maxage = 2.0
+
+# A request can have a deadline in seconds, e.g.
+# {"dev": "mfc-ch4-2", "cmd": "get_flow", "args": [""], "deadline": 0.5}
+# If the device hasn't answered by then, the bundle is replied with status
+# "Timeout" for it and the command is left to finish on its channel. This is
+# the deadline of the requests which don't give one, None is no deadline.
+cmd_deadline = None
+
 def gen_init_js():
     print 'function init_state() {'
     for d,p in devlist.iteritems():
@@ -0,0 +1,202 @@
+# dispatch layer between the servers and the channel modules.
+#
+# The servers (threaded one in controlserver.py and the event loop one in
+# asyncserver.py) don't call the device functions themselves. They hand the
+# function and its args to an executor and get back a Future, which is filled
+# in with the (status, value) pair when the call returns.
+#
+# There is one single threaded executor for each physical channel (see
+# controlserver.py), which drains its queue. So a bus is used by one command
+# at a time, and the number of threads doesn't grow with the number of
+# commands being sent by the clients. The commands are taken by their
+# priority class (see PrioQueue), in the order they arrived within a class.
+import threading
+import collections
+import heapq
+import traceback
+import time
+
+class Future():
+    def __init__(self):
+        self._ev, self._lock = threading.Event(), threading.Lock()
+        self._res, self._cbs = None, []
+    def set_result(self, res):
+        # the first result stays, returns False if there was one already.
+        with self._lock:
+            if self._ev.is_set(): return False
+            self._res = res
+            self._ev.set()
+            cbs, self._cbs = self._cbs, []
+        for cb in cbs: self._run_cb(cb)
+        return True
+    def _run_cb(self, cb):
+        # an error in a callback must not kill the worker setting the result.
+        try: cb(self)
+        except Exception: traceback.print_exc()
+    def done(self): return self._ev.is_set()
+    def result(self, timeout=None):
+        self._ev.wait(timeout)
+        return self._res
+    def add_done_callback(self, cb):
+        # cb is called from the thread which sets the result, or right
+        # away if it is already there.
+        with self._lock:
+            if not self._ev.is_set():
+                self._cbs.append(cb)
+                return
+        self._run_cb(cb)
+
+# runs the functions given to call_later, from one thread.
+class _Timers(threading.Thread):
+    def __init__(self):
+        threading.Thread.__init__(self, name='timers')
+        self.daemon = True
+        self.heap, self.n, self.cv = [], 0, threading.Condition()
+    def call_at(self, t, fn):
+        with self.cv:
+            self.n += 1
+            heapq.heappush(self.heap, (t, self.n, fn))
+            self.cv.notify()
+    def run(self):
+        while True:
+            with self.cv:
+                while len(self.heap) == 0 or self.heap[0][0] > time.time():
+                    self.cv.wait(self.heap[0][0] - time.time() if self.heap else None)
+                t, n, fn = heapq.heappop(self.heap)
+            try: fn()
+            except Exception: traceback.print_exc()
+
+_timers, _timers_lock = None, threading.Lock()
+def call_later(dt, fn):
+    global _timers
+    with _timers_lock:
+        if _timers is None:
+            _timers = _Timers()
+            _timers.start()
+    _timers.call_at(time.time() + dt, fn)
+
+# a Future with the result of f, or with status 'Timeout' if f isn't done in
+# timeout seconds. The command of f is left to finish, its result is dropped.
+def with_deadline(f, timeout):
+    if f.done(): return f
+    g = Future()
+    f.add_done_callback(lambda f: g.set_result(f.result()))
+    call_later(timeout, lambda: g.set_result(('Timeout', ['No reply in %g s'%(timeout)])))
+    return g
+
+def done_future(res):
+    f = Future()
+    f.set_result(res)
+    return f
+
+# calls the device function, errors are returned in the same form as the
+# device functions return theirs.
+def call(func, args):
+    try: return func(args)
+    except Exception as e: return 'Error', [repr(e)]
+
+# the device functions report errors as status 'Error' (-1 for sierra mfc),
+# the init_state functions don't return anything.
+def failed(res): return isinstance(res, tuple) and res[0] not in ('OK', 0)
+
+# priority classes of the commands on a channel, lower ones go first:
+# the commands which change something (set_flow, close, set_state, ..), then
+# the reads asked for by the clients, then the reads of the poller.
+ACTUATE, READ, POLL = 0, 1, 2
+
+class PrioQueue():
+    # a queue for each class. The first command of the highest class is taken,
+    # unless the first one of some class has waited for more than aging
+    # seconds, then the one which has waited the longest is taken. So the
+    # lower classes are delayed but not starved.
+    def __init__(self, nclasses=3, aging=2.0):
+        self.qs = [collections.deque() for i in range(nclasses)]
+        self.aging, self.cv = aging, threading.Condition()
+    def put(self, prio, item):
+        # item is a tuple whose last element is the time it was posted.
+        with self.cv:
+            self.qs[prio].append(item)
+            self.cv.notify()
+    def get(self):
+        with self.cv:
+            while not any(self.qs): self.cv.wait()
+            now = time.time()
+            aged = [q for q in self.qs if len(q) > 0 and now - q[0][-1] > self.aging]
+            if len(aged) > 0: q = min(aged, key=lambda q: q[0][-1])
+            else: q = [q for q in self.qs if len(q) > 0][0]
+            return q.popleft()
+
+class Executor():
+    def __init__(self, nworkers=1, name='executor', stats=None, aging=2.0):
+        # stats (see stats.py) is told the queue wait and run time of every
+        # command which is submitted with a tag.
+        self.name, self.q, self.stats = name, PrioQueue(aging=aging), stats
+        self.workers = []
+        for i in range(nworkers):
+            t = threading.Thread(target=self._run, name='%s-%d'%(name, i))
+            t.daemon = True
+            t.start()
+            self.workers.append(t)
+    def submit(self, func, args, tag=None, prio=READ):
+        f = Future()
+        self.q.put(prio, (func, args, f, tag, time.time()))
+        return f
+    def _run(self):
+        while True:
+            func, args, f, tag, t_post = self.q.get()
+            t0 = time.time()
+            res = call(func, args)
+            if self.stats is not None and tag is not None:
+                self.stats.add(self.name, tag, t0-t_post, time.time()-t0, failed(res))
+            f.set_result(res)
+
+# the reads can be shared between the clients asking for the same thing at
+# the same time. Everything else (set_flow, open, set_state, ..) changes the
+# device and is always sent.
+def readonly(cmd): return cmd[:4] == 'get_'
+
+# single flight: while a read is queued or on the bus, the same read from
+# another client is given the same Future instead of a second transaction.
+class SingleFlight():
+    def __init__(self):
+        self.lock, self.inflight = threading.Lock(), {}
+    def submit(self, key, start):
+        # start() posts the command and returns its Future.
+        with self.lock:
+            f = self.inflight.get(key)
+            if f is not None: return f
+            f = self.inflight[key] = start()
+        f.add_done_callback(lambda f: self._done(key, f))
+        return f
+    def _done(self, key, f):
+        with self.lock:
+            if self.inflight.get(key) is f: del self.inflight[key]
+
+# runs the groups of functions at the same time, each group in a thread of
+# its own and its functions one after another. Raises the first error once
+# all the groups are over.
+def run_parallel(groups):
+    errors = []
+    def run(fns):
+        for fn in fns:
+            try: fn()
+            except Exception as e:
+                traceback.print_exc()
+                errors.append(e)
+                return
+    ths = [threading.Thread(target=run, args=(fns,)) for fns in groups]
+    for t in ths: t.start()
+    for t in ths: t.join()
+    if len(errors) > 0: raise errors[0]
+
+# calls cb() once all the futures are done.
+def when_all(futs, cb):
+    if len(futs) == 0: return cb()
+    left = [len(futs)]
+    lock = threading.Lock()
+    def one_done(f):
+        with lock:
+            left[0] -= 1
+            last = left[0] == 0
+        if last: cb()
+    for f in futs: f.add_done_callback(one_done)
@@ -0,0 +1,251 @@
+# emulators of the furnace devices, for running the control server without
+# the hardware (see bench.py).
+#
+# The serial devices are emulated on pseudo terminals: the control server
+# opens the slave side (path) as it would open /dev/ttyUSB0, the emulator
+# answers on the master side with the byte formats of the devices:
+#   TVC        T3Bi throttle valve controller on rs232, '#' command modifier
+#   SierraMFC  Sierra C50L mfc on rs232 (note that sierra_mfc.cmd_io in
+#              rs232.py returns a constant and doesn't talk to it right now)
+#   BrooksBus  Brooks mfcs on the rs485 bus, answering to their macids
+# The bytes are sent back after the device's response time plus the time
+# they take on the line at the given baud rate, so the latencies seen by the
+# server are close to those with the hardware.
+#
+# fake_u6() returns a module which can be put in sys.modules as u6, its U6()
+# answers the LabJack calls used in labjack.py.
+import os
+import tty
+import time
+import types
+import random
+import threading
+import struct
+
+class PtyDevice(threading.Thread):
+    def __init__(self, name, baud, latency):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.baud, self.latency = baud, latency
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        # the slave stays open here, so the master doesn't see a hangup
+        # when the server closes and reopens the port.
+        self.path = os.ttyname(self.slave)
+        self.buf, self.nreq = '', 0
+
+    def run(self):
+        while True:
+            try: d = os.read(self.master, 1024)
+            except OSError: return
+            self.buf += d
+            while True:
+                r = self.consume()
+                if r is None: break
+                self.nreq += 1
+                if r: self.reply(r)
+
+    def reply(self, s):
+        # the bytes come out as they would on the line, a few at a time.
+        time.sleep(self.latency)
+        for i in range(0, len(s), 8):
+            time.sleep(len(s[i:i+8])*10.0/self.baud)
+            os.write(self.master, s[i:i+8])
+
+    # takes one command off self.buf and returns its reply ('' for none),
+    # None if there isn't a whole command in the buffer.
+    def consume(self): raise NotImplementedError
+
+def _noise(x, frac=0.002): return x + random.gauss(0, abs(x)*frac + 1e-3)
+
+class TVC(PtyDevice):
+    # replies status + value + '\r', status 0 is OK and 1 an unknown command.
+    # Some commands don't have replies (eps=0 in rs232._cmd_io).
+    build = '01.04.05  Nov 05 2008 17:29:52 VMD:02.00'
+    _noreply = ['O', 'C', 'H', 'Q', 'IX', 'L', 'J']
+    _setp_idx = {'1':'1', '2':'2', '3':'3', '4':'4', '10':'5', '0':'0'}
+    _mode_req = dict((str(25+i), str(i)) for i in range(6))
+    _soft_req = dict((str(14+i), str(i)) for i in range(1, 9))
+    _phase_req = dict([(str(40+i), str(i)) for i in range(1, 6)] + [('53', '6')])
+    _gain_req = dict([(str(45+i), str(i)) for i in range(1, 6)] + [('54', '6')])
+
+    def __init__(self, baud=9600, latency=0.005):
+        PtyDevice.__init__(self, 'tvc-emulator', baud, latency)
+        self.position, self.actv, self.ss = 0.0, '6', '1'
+        self.high, self.low = '10', '06'
+        self.setp = dict((str(i), ['0', 0.0, 100.0, 20, 20]) for i in range(7))
+
+    def pressure(self):
+        # in % of the high sensor range, falls as the valve opens.
+        return _noise(0.5 + 0.4*(100.0 - self.position))
+
+    def consume(self):
+        if '\n' not in self.buf: return None
+        line, self.buf = self.buf.split('\n', 1)
+        if line[:1] in '#!@': line = line[1:]
+        if line in self._noreply:
+            if line == 'O': self.position, self.actv = 100.0, '6'
+            elif line == 'C': self.position, self.actv = 0.0, '7'
+            return ''
+        r = self.answer(line)
+        if r is None: return '1' + line + '\r'
+        return '0' + r + '\r'
+
+    def answer(self, c):
+        if c == 'R5': return 'P+%08.4f'%(self.pressure())
+        if c == 'R6': return 'V+%08.4f'%(_noise(self.position))
+        if c == 'R7': return 'M%s%s%s1'%(self.actv, '0' if self.actv not in '67' else
+                {'6':'2', '7':'4'}[self.actv], '1' if self.pressure() > 10 else '0')
+        if c == 'R66': return self.build
+        if c == 'R33': return 'EH'+self.high
+        if c == 'R55': return 'EL'+self.low
+        if c == 'R34': return 'F00'
+        if c == 'R51': return 'V1'
+        if c == 'R35': return 'G1'
+        if c == 'R24': return 'A0'
+        if c == 'RSS': return 'SS'+self.ss
+        if c[:2] == 'SS': self.ss = c[2:]; return c
+        if c in ['CAL1234', 'USR']: return c
+        if c[:2] in ['EH', 'EL']:
+            if c[1] == 'H': self.high = c[2:]
+            else: self.low = c[2:]
+            return c
+        if c[:1] == 'D' and len(c) == 2 and c[1] in '012345':
+            # activate a setpoint, position mode moves the valve to its value.
+            s, self.actv = self.setp[c[1]], c[1]
+            if s[0] == '0': self.position = s[1]
+            return c
+        if c[:1] in 'TSIMX' and len(c) > 2:
+            s = self.setp.setdefault(c[1], ['0', 0.0, 100.0, 20, 20])
+            k = 'TSIMX'.index(c[0])
+            try: s[k] = c[2] if k == 0 else float(c[2:])
+            except ValueError: return None
+            return c
+        if c[:1] == 'R':
+            n = c[1:]
+            for req, prefix, k in [(self._setp_idx, 'S', 1), (self._mode_req, 'T', 0),
+                    (self._soft_req, 'I', 2), (self._gain_req, 'M', 3), (self._phase_req, 'X', 4)]:
+                if n in req:
+                    s = self.setp.setdefault(req[n], ['0', 0.0, 100.0, 20, 20])
+                    if k == 0: return 'T'+req[n]+s[0]
+                    return prefix+req[n]+'%.2f'%(s[k])
+        if c[:1] in 'LVGFA': return c
+        return None
+
+def lrc(cmd):
+    # same as sierra_mfc.lrc in rs232.py.
+    return hex((-(sum(ord(c) for c in cmd)%256) + 256)%256)[2:]
+
+class SierraMFC(PtyDevice):
+    # '?Cmd' reads and '!CmdVal' writes, both followed by LRC CRLF, replies
+    # are CmdVal LRC CRLF.
+    def __init__(self, fs_range=50.0, baud=9600, latency=0.01):
+        PtyDevice.__init__(self, 'sierra-emulator', baud, latency)
+        self.fs_range, self.setp = fs_range, 0.0
+
+    def consume(self):
+        if '\n' not in self.buf: return None
+        line, self.buf = self.buf.split('\n', 1)
+        c = line.rstrip('\r')
+        # the lrc is one or two hex digits.
+        for k in [2, 1]:
+            if len(c) > 5 and lrc(c[:-k]) == c[-k:]:
+                c = c[:-k]
+                break
+        else: return ''
+        cmd, val = c[1:5], c[5:]
+        if cmd == 'Setr':
+            if c[0] == '!':
+                try: self.setp = float(val)
+                except ValueError: pass
+            r = cmd + '%.1f'%(self.setp)
+        elif cmd == 'Flow': r = cmd + '%.3f'%(max(0.0, _noise(self.setp)))
+        elif cmd == 'Fscl': r = cmd + '%.1f'%(self.fs_range)
+        elif cmd == 'Gnam': r = cmd + 'N2'
+        elif cmd == 'Unts': r = cmd + 'SCCM'
+        elif cmd == 'Vern': r = cmd + '1.0'
+        elif cmd == 'Srnm': r = cmd + '000000'
+        else: r = cmd + val
+        return r + lrc(r) + '\r\n'
+
+def _checksum(s): return chr(sum(ord(c) for c in s)%256)
+
+class BrooksBus(PtyDevice):
+    # packets of rs485.form_cmd: macid stx ccode len class inst attr data pad
+    # cksum. A device acks a packet addressed to it, and then sends the reply
+    # packet for reads or another ack for writes. Stray acks from the host are
+    # skipped.
+    _ACK, _STX = '\x06', '\x02'
+
+    def __init__(self, macids, fs_range=10.0, baud=115200, latency=0.001):
+        PtyDevice.__init__(self, 'brooks-emulator', baud, latency)
+        self.fs_range = fs_range
+        self.setp = dict((chr(m), 0x4000) for m in macids)
+
+    def consume(self):
+        while self.buf[:1] in [self._ACK, '\x16']: self.buf = self.buf[1:]
+        if len(self.buf) < 4: return None
+        if self.buf[1] != self._STX:
+            self.buf = self.buf[1:]
+            return ''
+        n = 4 + ord(self.buf[3]) + 2
+        if len(self.buf) < n: return None
+        pkt, self.buf = self.buf[:n], self.buf[n:]
+        macid, ccode, func, data = pkt[0], pkt[2], pkt[4:7], pkt[7:n-2]
+        if macid not in self.setp: return ''
+        if _checksum(pkt[1:-1]) != pkt[-1]: return '\x16'
+        if ccode == '\x81':
+            if func == '\x69\x01\xA6': self.setp[macid] = struct.unpack('<H', data[1:3])[0]
+            elif func == '\x69\x01\xA4': self.setp[macid] = struct.unpack('<H', data[0:2])[0]
+            return self._ACK + self._ACK
+        if func == '\x6A\x01\xA9':
+            c = int(max(0x4000, min(0xC000, _noise(self.setp[macid], 0.001))))
+            d = struct.pack('<H', c)
+        elif func == '\x6A\x01\xA6': d = struct.pack('<H', self.setp[macid])
+        elif func == '\x03\x01\x65': d = struct.pack('<I', 115200)
+        elif func == '\x03\x01\x01': d = macid
+        else: d = '\x00\x00'
+        msg = self._STX + ccode + chr(len(d)+3) + func + d + '\x00'
+        return self._ACK + macid + msg + _checksum(msg)
+
+def fake_u6(ain_dac, latency=0.001):
+    # ain_dac maps the analog inputs to the DACs driving the same mfc, the
+    # input follows the output.
+    u6 = types.ModuleType('u6')
+    class LabJackException(Exception): pass
+    class DAC16():
+        def __init__(self, dac, bits): self.dac, self.bits = dac, bits
+    class AIN24():
+        def __init__(self, *args): self.args = args
+    class CalInfo():
+        dac0Slope, dac0Offset, dac1Slope, dac1Offset = 13200.0, 0.0, 13200.0, 0.0
+    class U6():
+        def __init__(self):
+            self.calInfo, self.dio, self.dac = CalInfo(), {}, {0: 0.0, 1: 0.0}
+            self.lock = threading.Lock()
+        def _usb(self):
+            time.sleep(latency)
+        def getCalibrationData(self):
+            self._usb()
+            return self.calInfo
+        def getAIN(self, n, *args):
+            self._usb()
+            return max(0.0, _noise(self.dac.get(ain_dac.get(n), 0.0)))
+        def getFeedback(self, *cmds):
+            self._usb()
+            for c in cmds:
+                if isinstance(c, DAC16):
+                    slope = getattr(self.calInfo, 'dac%dSlope'%(c.dac))
+                    offset = getattr(self.calInfo, 'dac%dOffset'%(c.dac))
+                    self.dac[c.dac] = (c.bits - offset)/slope
+            return [0]*len(cmds)
+        def getDIOState(self, n):
+            self._usb()
+            return self.dio.get(n, 0)
+        def setDIOState(self, n, st):
+            self._usb()
+            self.dio[n] = st
+        def close(self): pass
+    for x in [LabJackException, DAC16, AIN24, U6]: setattr(u6, x.__name__, x)
+    return u6
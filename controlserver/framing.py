@@ -0,0 +1,208 @@
+# compact binary framing for the control server protocol.
+#
+# Json lines stay the default. A client can switch its connection to binary
+# frames by sending the plain bundle
+#   [{"dev": "controller", "cmd": "framing", "args": ["binary"]}]
+# and waiting for its (json) reply. The value in the reply has the tables
+# {"devs": [..], "cmds": [..], "statuses": [..]}, in binary frames devices,
+# commands and statuses are sent as their index in these tables. After the
+# reply every message, in either direction, is a frame:
+#   uint32 length of the rest | char kind | body
+# kind 'Q' (request): uint32 id | uint16 n | n * (uint16 dev, uint16 cmd,
+#                     uint8 flags, uint8 nargs, nargs * str)
+# kind 'R' (reply):   uint32 id | uint16 n | n * entry
+# kind 'S' (samples): float64 time | uint16 n | n * entry
+# entry: uint16 dev, uint16 cmd, uint8 status, float32 age (NaN if the value
+#        was not from the poller), uint8 nvals, nvals * val
+# val:   'f' float64 | 'F' uint8 count, count * float64 (for comma separated
+#        values, e.g. the pressure,position of tvc) | 's' str | 'j' str (json)
+# str:   uint16 length | utf-8 bytes
+# Request flags: 1 = fresh (see devconfig.py). Binary requests are always
+# answered as soon as they finish, the id is used to match the replies.
+# The same command in binary {"dev": "controller", "cmd": "framing",
+# "args": ["json"]} switches back to json lines.
+#
+# Numbers go as packed floats, so a client gets floats back instead of the
+# formatted strings of the json replies.
+#
+# python ./framing.py compares the encoding/decoding time of a poll reply
+# with that of json.
+import struct
+import json
+
+statuses = ['OK', 'Error', 'Timeout']
+NONE = 0xffff # dev/cmd index of error entries which don't have one.
+_FRESH = 1
+
+_hdr = struct.Struct('!I')
+_req_hdr = struct.Struct('!cIH')
+_req_entry = struct.Struct('!HHBB')
+_rep_hdr = struct.Struct('!cIH')
+_smp_hdr = struct.Struct('!cdH')
+_entry = struct.Struct('!HHBfB')
+_entry1f = struct.Struct('!HHBfBcd') # an entry with one float, the usual poll reply.
+_f = struct.Struct('!d')
+_strlen = struct.Struct('!H')
+_nan = float('nan')
+
+def frame_length(hdr): return _hdr.unpack(hdr)[0]
+
+def _pack_str(s):
+    if isinstance(s, unicode): s = s.encode('utf-8')
+    return _strlen.pack(len(s)) + s
+
+def _unpack_str(b, i):
+    n = _strlen.unpack_from(b, i)[0]
+    i += _strlen.size
+    return b[i:i+n].decode('utf-8'), i+n
+
+def _pack_val(v):
+    if isinstance(v, (int, long, float)) and not isinstance(v, bool):
+        return 'f' + _f.pack(v)
+    if isinstance(v, basestring):
+        try: return 'f' + _f.pack(float(v))
+        except ValueError: pass
+        if ',' in v:
+            try:
+                fs = [float(x) for x in v.split(',')]
+                return 'F' + chr(len(fs)) + ''.join(_f.pack(x) for x in fs)
+            except ValueError: pass
+        return 's' + _pack_str(v)
+    return 'j' + _pack_str(json.dumps(v))
+
+def _unpack_val(b, i):
+    t, i = b[i], i+1
+    if t == 'f': return _f.unpack_from(b, i)[0], i+_f.size
+    if t == 'F':
+        n, i = ord(b[i]), i+1
+        return [_f.unpack_from(b, i+k*_f.size)[0] for k in range(n)], i+n*_f.size
+    s, i = _unpack_str(b, i)
+    if t == 'j': s = json.loads(s)
+    return s, i
+
+_status_codes = dict((s, i) for i, s in enumerate(statuses))
+def status_code(st):
+    if st in _status_codes: return _status_codes[st]
+    if st == 0: return 0 # sierra mfc returns 0/-1
+    return 1
+
+class Framing():
+    def __init__(self, devs, cmds):
+        self.devs, self.cmds = list(devs), list(cmds)
+        self.devidx = dict((d, i) for i, d in enumerate(self.devs))
+        self.cmdidx = dict((c, i) for i, c in enumerate(self.cmds))
+
+    def extend(self, devs, cmds):
+        # adds the new ones at the end, the indices of the others stay.
+        for xs, l, idx in [(devs, self.devs, self.devidx), (cmds, self.cmds, self.cmdidx)]:
+            for x in xs:
+                if x not in idx and x != 'handle':
+                    idx[x] = len(l)
+                    l.append(x)
+
+    def tables(self):
+        return {'devs': self.devs, 'cmds': self.cmds, 'statuses': statuses}
+
+    def _frame(self, body): return _hdr.pack(len(body)) + body
+
+    def _pack_entries(self, res):
+        out = []
+        for x in res:
+            v = x['value'] if 'value' in x else x.get('error', [])
+            if not isinstance(v, list): v = [v]
+            dev, cmd = self.devidx.get(x.get('dev'), NONE), self.cmdidx.get(x.get('cmd'), NONE)
+            st, age = status_code(x.get('status')), x.get('age', _nan)
+            if len(v) == 1 and not (isinstance(v[0], basestring) and ',' in v[0]):
+                try:
+                    out.append(_entry1f.pack(dev, cmd, st, age, 1, 'f', float(v[0])))
+                    continue
+                except (ValueError, TypeError): pass
+            out.append(_entry.pack(dev, cmd, st, age, len(v)))
+            out.extend(_pack_val(y) for y in v)
+        return ''.join(out)
+
+    def _unpack_entries(self, b, i, n):
+        res = []
+        for k in range(n):
+            dev, cmd, st, age, nv = _entry.unpack_from(b, i)
+            i += _entry.size
+            x = {'status': statuses[st]}
+            if dev != NONE: x['dev'] = self.devs[dev]
+            if cmd != NONE: x['cmd'] = self.cmds[cmd]
+            if age == age: x['age'] = age # not NaN
+            v = []
+            for j in range(nv):
+                y, i = _unpack_val(b, i)
+                v.append(y)
+            x['value'] = v
+            res.append(x)
+        return res, i
+
+    # server side
+    def encode_reply(self, rid, res):
+        return self._frame(_rep_hdr.pack('R', rid, len(res)) + self._pack_entries(res))
+
+    def encode_samples(self, t, samples):
+        return self._frame(_smp_hdr.pack('S', t, len(samples)) + self._pack_entries(samples))
+
+    def decode_request(self, b):
+        # b is the frame without its length, returns (id, bundle).
+        kind, rid, n = _req_hdr.unpack_from(b, 0)
+        if kind != 'Q': raise ValueError('Not a request frame: '+repr(kind))
+        i, bundle = _req_hdr.size, []
+        for k in range(n):
+            dev, cmd, flags, na = _req_entry.unpack_from(b, i)
+            i += _req_entry.size
+            args = []
+            for j in range(na):
+                a, i = _unpack_str(b, i)
+                args.append(a)
+            r = {'dev': self.devs[dev], 'cmd': self.cmds[cmd], 'args': args}
+            if flags & _FRESH: r['fresh'] = True
+            bundle.append(r)
+        return rid, bundle
+
+    # client side
+    def encode_request(self, rid, bundle):
+        out = [_req_hdr.pack('Q', rid, len(bundle))]
+        for r in bundle:
+            args = r.get('args', [])
+            out.append(_req_entry.pack(self.devidx[r['dev']], self.cmdidx[r['cmd']],
+                _FRESH if r.get('fresh') else 0, len(args)))
+            out.extend(_pack_str(a) for a in args)
+        return self._frame(''.join(out))
+
+    def decode(self, b):
+        # returns ('R', id, res) or ('S', time, samples).
+        kind = b[0]
+        if kind == 'R': kind, x, n = _rep_hdr.unpack_from(b, 0); i = _rep_hdr.size
+        elif kind == 'S': kind, x, n = _smp_hdr.unpack_from(b, 0); i = _smp_hdr.size
+        else: raise ValueError('Unknown frame: '+repr(kind))
+        res, i = self._unpack_entries(b, i, n)
+        return kind, x, res
+
+# the samples pushed to a subscribed connection, fr is None for json.
+def encode_samples(fr, t, samples):
+    if fr is not None: return fr.encode_samples(t, samples)
+    return json.dumps({'t':t, 'samples':samples})+'\n'
+
+
+if __name__ == '__main__':
+    import timeit
+    import devconfig
+    devs = ['controller'] + sorted(devconfig.devlist.keys())
+    fr = Framing(devs, ['get_flow', 'get_pressure_position'])
+    res = [{'dev':'mfc-h2-2', 'cmd':'get_flow', 'status':'OK', 'value':['12.345'], 'age':0.12},
+        {'dev':'mfc-ch4-2', 'cmd':'get_flow', 'status':'OK', 'value':['1.234']},
+        {'dev':'mfc-h2-1', 'cmd':'get_flow', 'status':'OK', 'value':['100.000'], 'age':0.1},
+        {'dev':'mfc-n2-1', 'cmd':'get_flow', 'status':'OK', 'value':['0.500'], 'age':0.1},
+        {'dev':'tvc', 'cmd':'get_pressure_position', 'status':'OK', 'value':['12.34567,45.6700']}]
+    j, b = json.dumps(res)+'\n', fr.encode_reply(7, res)
+    n = 20000
+    for name, enc, dec in [
+            ('json', lambda: json.dumps(res)+'\n', lambda: json.loads(j)),
+            ('binary', lambda: fr.encode_reply(7, res), lambda: fr.decode(b[4:]))]:
+        te = timeit.timeit(enc, number=n)/n*1e6
+        td = timeit.timeit(dec, number=n)/n*1e6
+        size = len(j) if name == 'json' else len(b)
+        print '%-7s %4d bytes, encode %6.1f us, decode %6.1f us per poll reply'%(name, size, te, td)
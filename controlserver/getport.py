@@ -1,4 +1,8 @@
 import serial
+import os
+import glob
+import json
+import threading
 
 def _check_for_tvcport(portnames):
     _cmd_mod = '#'
@@ -13,16 +17,53 @@ def _check_for_tvcport(portnames):
         return res[1:]
 
     build = '01.04.05  Nov 05 2008 17:29:52 VMD:02.00'
-    for pn in portnames:
-        port = serial.Serial(pn, timeout=0.05)
-        b = _cmd_io(port, 'R66')
-        if b==build: return pn
+    # all the ports are asked at the same time.
+    found = []
+    def probe(pn):
+        try:
+            port = serial.Serial(pn, timeout=0.05)
+            try: b = _cmd_io(port, 'R66')
+            finally: port.close()
+        except (serial.serialutil.SerialException, OSError, IndexError): return
+        if b==build: found.append(pn)
+    ths = [threading.Thread(target=probe, args=(pn,)) for pn in portnames]
+    for t in ths: t.start()
+    for t in ths: t.join()
+    if len(found) > 0: return found[0]
     return 'No port found'
 
+# The association is cached in portcache.json by the stable names of the
+# ports in /dev/serial/by-id (made by udev from the usb-serial adapter's
+# vendor, product and serial number), as ttyUSB numbers change with the order
+# the adapters are found. The ports are probed again only if a cached name is
+# gone or doesn't point to one of the ports any more.
+cachefile = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'portcache.json')
+
+def _stable_names():
+    # {/dev/ttyUSBn: /dev/serial/by-id/...}
+    return dict((os.path.realpath(p), p) for p in glob.glob('/dev/serial/by-id/*'))
+
+def _cached(ttyusbs):
+    try: c = json.load(open(cachefile))
+    except (IOError, ValueError): return None
+    res = dict((str(k), str(os.path.realpath(v))) for k, v in c.iteritems())
+    if sorted(res.keys()) != ['mfc-n2-1', 'tvc'] or res['tvc'] == res['mfc-n2-1']: return None
+    if any(p not in ttyusbs for p in res.itervalues()): return None
+    return res
+
+def _save(assoc):
+    names = _stable_names()
+    if any(p not in names for p in assoc.itervalues()): return # nothing stable to cache.
+    try:
+        with open(cachefile, 'w') as f: json.dump(dict((k, names[p]) for k, p in assoc.iteritems()), f)
+    except IOError: pass
+
 def associate_ports():
-    import glob
-    ttyusbs = glob.glob('/dev/ttyUSB*')
+    ttyusbs = sorted(glob.glob('/dev/ttyUSB*'))
+    c = _cached(ttyusbs)
+    if c is not None: return c
     tvcport = _check_for_tvcport(ttyusbs)
     mfcn2port = [x for x in ttyusbs if x!=tvcport][0]
-    return {'tvc': tvcport, 'mfc-n2-1': mfcn2port}
-
+    assoc = {'tvc': tvcport, 'mfc-n2-1': mfcn2port}
+    if tvcport in ttyusbs: _save(assoc)
+    return assoc
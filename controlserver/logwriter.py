@@ -0,0 +1,200 @@
+# log writer which keeps the disk out of the request path.
+#
+# The records are put on a queue by the request threads and written out by
+# a background thread in batches. The file is flushed after every batch and
+# fsync'ed every fsync_interval seconds. The log file is changed (startnew/
+# stoplog controller commands) by the same thread, in order with the records,
+# so the files are opened only when they are changed and not per connection.
+#
+# Next to the text log, the values in the replies are also recorded in binary
+# (<logfile>.tlm), as fixed size records of
+#   float64 monotonic time, uint16 device, uint16 command, float32 value, uint8 status
+# (little endian, packed, 17 bytes). Device, command and status are indices
+# in the tables written to <logfile>.tlm.json, along with the wall clock time
+# of monotonic time 0. A reply with many values (e.g. pressure,position of
+# tvc) has a record for each of them, in order, with the same time. Switch
+# states are recorded as 1 (flow) and 0 (noflow). These files can be mapped
+# straight into arrays, see readlog.load_telemetry.
+# The records are appended to an existing .tlm only if its tables are the
+# same (or the new ones only add devices and commands at the end, see
+# reload_config) and its clock base is the same. Otherwise (devconfig has
+# changed, or the machine has been rebooted and the monotonic clock has
+# started again) the old records are moved to <logfile>.tlm.<n> and
+# .tlm.<n>.json, and a new .tlm is started.
+import logging
+import threading
+import Queue
+import time
+import os
+import struct
+import json
+import traceback
+import framing
+
+# monotonic clock, python 2 doesn't have time.monotonic.
+try:
+    import ctypes, ctypes.util
+    class _timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+    _clock_gettime = ctypes.CDLL(ctypes.util.find_library('rt') or
+            ctypes.util.find_library('c'), use_errno=True).clock_gettime
+    def monotonic():
+        t = _timespec()
+        _clock_gettime(1, ctypes.byref(t)) # 1 is CLOCK_MONOTONIC
+        return t.tv_sec + t.tv_nsec*1e-9
+    monotonic()
+except Exception: monotonic = time.time
+
+tlm_record = struct.Struct('<dHHfB')
+_switch_vals = {'flow': 1.0, 'noflow': 0.0}
+
+def _floats(v):
+    if not isinstance(v, list): v = [v]
+    for x in v:
+        if isinstance(x, basestring):
+            if x in _switch_vals:
+                yield _switch_vals[x]
+                continue
+            for y in x.split(','):
+                try: yield float(y)
+                except ValueError: pass
+        elif isinstance(x, (int, long, float)) and not isinstance(x, bool): yield float(x)
+
+class LogWriter(logging.Handler):
+    def __init__(self, fname, viewlink, fsync_interval=5.0, batch=1000):
+        logging.Handler.__init__(self)
+        self.viewlink, self.fsync_interval, self.batch = viewlink, fsync_interval, batch
+        self.q, self.f, self.last_sync = Queue.Queue(), None, time.time()
+        self.tlm, self.tables, self.fname = None, None, None
+        self._open(fname)
+        self.writer = threading.Thread(target=self._run, name='logwriter')
+        self.writer.daemon = True
+        self.writer.start()
+
+    def emit(self, record):
+        self.q.put(record)
+
+    def set_tables(self, tables):
+        # tables is a framing.Framing, the telemetry is recorded from now on.
+        self.q.put(('tables', tables))
+
+    def record(self, res):
+        # res is a reply list, as sent to the clients.
+        self.q.put(('tlm', monotonic(), res))
+
+    def switch(self, fname):
+        # the records logged before this call go to the old file.
+        self.q.put(('switch', fname))
+
+    def flush(self):
+        # waits till everything queued so far is on disk.
+        ev = threading.Event()
+        self.q.put(('flush', ev))
+        ev.wait(10.0)
+
+    def _open(self, fname):
+        # the old file is kept if the new one can't be opened.
+        f = open(fname, 'a')
+        if self.f is not None:
+            self._sync()
+            self.f.close()
+        self.f, self.fname = f, fname
+        # update the symlink to it.
+        try: os.unlink(self.viewlink)
+        except OSError: pass
+        try: os.symlink(fname, self.viewlink)
+        except OSError: pass
+        self._open_tlm()
+
+    def _open_tlm(self):
+        if self.tlm is not None: self.tlm.close()
+        self.tlm = None
+        if self.tables is None: return
+        fname = self.fname+'.tlm'
+        hdr = {'record': 't:<f8,dev:<u2,cmd:<u2,value:<f4,status:u1',
+            'wall_t0': time.time()-monotonic(), 'devs': self.tables.devs,
+            'cmds': self.tables.cmds, 'statuses': framing.statuses}
+        old = self._segment(fname)
+        if old is not None and not self._continues(old, hdr):
+            n = 1
+            while os.path.exists('%s.%d'%(fname, n)): n += 1
+            os.rename(fname, '%s.%d'%(fname, n))
+            if os.path.exists(fname+'.json'): os.rename(fname+'.json', '%s.%d.json'%(fname, n))
+        elif old is not None: hdr['wall_t0'] = old['wall_t0']
+        with open(fname+'.json', 'w') as f: json.dump(hdr, f)
+        self.tlm = open(fname, 'ab')
+
+    def _segment(self, fname):
+        # the header of the records in fname, None if there are none.
+        if not os.path.exists(fname) or os.path.getsize(fname) == 0: return None
+        try: return json.load(open(fname+'.json'))
+        except (IOError, ValueError): return {}
+
+    def _continues(self, old, hdr):
+        # the old indices stay the same in the new tables, and the clock base
+        # is the same within a second.
+        n, m = len(old.get('devs', [])), len(old.get('cmds', []))
+        return (n > 0 and old['devs'] == hdr['devs'][:n] and old.get('cmds') == hdr['cmds'][:m] and
+            old.get('statuses') == hdr['statuses'] and abs(old.get('wall_t0', 0) - hdr['wall_t0']) < 1.0)
+
+    def _pack_tlm(self, t, res):
+        out = []
+        for x in res:
+            if 'dev' not in x or 'value' not in x: continue
+            dev = self.tables.devidx.get(x['dev'], framing.NONE)
+            cmd = self.tables.cmdidx.get(x['cmd'], framing.NONE)
+            st = framing.status_code(x.get('status'))
+            out.extend(tlm_record.pack(t, dev, cmd, v, st) for v in _floats(x['value']))
+        return ''.join(out)
+
+    def _sync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        if self.tlm is not None:
+            self.tlm.flush()
+            os.fsync(self.tlm.fileno())
+        self.last_sync = time.time()
+
+    def _run(self):
+        # the thread must not die, or nothing would be logged any more and
+        # the queue would grow: the errors are printed and it goes on.
+        while True:
+            evs = []
+            try: self._run_batch(evs)
+            except Exception: traceback.print_exc()
+            for ev in evs: ev.set()
+
+    def _run_batch(self, evs):
+        items = [self.q.get()]
+        try:
+            while len(items) < self.batch: items.append(self.q.get_nowait())
+        except Queue.Empty: pass
+        lines, recs = [], []
+        for x in items:
+            if isinstance(x, logging.LogRecord):
+                try: lines.append(self.format(x)+'\n')
+                except Exception: self.handleError(x)
+                continue
+            if x[0] == 'tlm':
+                if self.tlm is not None: recs.append(self._pack_tlm(x[1], x[2]))
+                continue
+            self._write(lines, recs)
+            lines, recs = [], []
+            if x[0] == 'switch':
+                try: self._open(x[1])
+                except (IOError, OSError) as e: print 'Could not change the log file to', x[1], e
+            elif x[0] == 'tables':
+                self.tables = x[1]
+                self._open_tlm()
+            elif x[0] == 'flush':
+                evs.append(x[1])
+                self._sync()
+        self._write(lines, recs)
+        if time.time() - self.last_sync > self.fsync_interval: self._sync()
+
+    def _write(self, lines, recs):
+        self.f.writelines(lines)
+        self.f.flush()
+        if self.tlm is not None:
+            self.tlm.write(''.join(recs))
+            self.tlm.flush()
@@ -0,0 +1,85 @@
+# background poller for the telemetry.
+#
+# The read commands listed in devconfig (the 'poll' entry of a device) are
+# run every interval seconds, and their latest results are kept in a table
+# along with the time they were taken. The clients asking for the same reads
+# are then answered from this table (see handle_line in controlserver.py),
+# so the bus traffic doesn't grow with the number of clients watching.
+import threading
+import time
+import dispatch
+
+class Poller(threading.Thread):
+    def __init__(self, polls, submit, interval, maxage):
+        # polls is a list of (dev, cmd), submit(dev, cmd, args, prio) posts
+        # the command to its channel and returns a Future. The polls go at
+        # the lowest priority, behind the clients' commands.
+        threading.Thread.__init__(self, name='poller')
+        self.daemon = True
+        self.polls, self.submit = polls, submit
+        self.interval, self.maxage = interval, maxage
+        self.table = {} # (dev, cmd): (status, value, time taken)
+        self.lock = threading.Lock()
+        self.listeners = [] # called after every round, see Subscription.
+
+    def run(self):
+        while True:
+            t0 = time.time()
+            self.poll_once()
+            time.sleep(max(0.0, self.interval - (time.time()-t0)))
+
+    def poll_once(self):
+        # all the channels are polled at the same time, each by its worker.
+        futs = [(k, self.submit(k[0], k[1], [''], dispatch.POLL)) for k in self.polls]
+        for k, f in futs:
+            status, value = f.result()
+            with self.lock: self.table[k] = (status, value, time.time())
+        now = time.time()
+        for cb in self.listeners[:]: cb(now)
+
+    def add_listener(self, cb):
+        with self.lock: self.listeners.append(cb)
+
+    def remove_listener(self, cb):
+        with self.lock:
+            if cb in self.listeners: self.listeners.remove(cb)
+
+    def get(self, dev, cmd):
+        # returns (status, value, age), or None if there is no recent value.
+        with self.lock: r = self.table.get((dev, cmd))
+        if r is None: return None
+        age = time.time() - r[2]
+        if age > self.maxage: return None
+        return r[0], r[1], age
+
+# a connection which has sent the subscribe command gets the polled values of
+# the devices it asked for pushed to it, as one json object per line:
+# {"t": time, "samples": [{"dev": .., "cmd": .., "status": .., "value": .., "age": ..}, ..]}
+# (or as 'S' frames, see framing.py). send(t, samples) does the pushing.
+# Samples are sent every interval seconds (rounded to the poll interval), or
+# with on_change only those which have changed since they were last sent.
+class Subscription():
+    def __init__(self, poller, devs, interval, on_change, send):
+        self.poller, self.send = poller, send
+        self.keys = [k for k in poller.polls if len(devs)==0 or k[0] in devs]
+        self.interval, self.on_change = interval, on_change
+        self.last_t, self.last_vals = 0.0, {}
+        poller.add_listener(self.on_round)
+
+    def on_round(self, now):
+        if now - self.last_t < self.interval - self.poller.interval/2: return
+        samples = []
+        for k in self.keys:
+            r = self.poller.get(k[0], k[1])
+            if r is None: continue
+            if self.on_change and self.last_vals.get(k) == r[:2]: continue
+            self.last_vals[k] = r[:2]
+            samples.append({'dev':k[0], 'cmd':k[1], 'status':r[0], 'value':r[1],
+                'age':round(r[2], 3)})
+        if len(samples) == 0: return
+        self.last_t = now
+        try: self.send(now, samples)
+        except Exception: self.cancel() # connection has gone away.
+
+    def cancel(self):
+        self.poller.remove_listener(self.on_round)
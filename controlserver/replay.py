@@ -0,0 +1,153 @@
+# replays the requests recorded in a control server log.
+#
+#   python ./replay.py log/log_controlserver.txt --speed 1 [--host 127.0.0.1]
+# The request bundles of every client connection in the log (the logger name
+# is the client's address, and a connection starts with "Started talking
+# to") are sent again over a connection of their own, at the times they were
+# sent first, scaled by --speed (2 is twice as fast, 0 is as fast as the
+# replies come). Reported are the latency of the bundles and where the
+# replies differ from the recorded ones: a different status, different
+# devices/commands or number of values, or a different value for a command
+# which isn't a read (read values change anyway, those are only counted).
+#
+# The log has the writes (set_flow etc.) too, so run it against a server
+# with emulated devices:
+#   python ./replay.py log/log_controlserver.txt --emulated [-- --evloop]
+# starts one the way bench.py does, or leave them out with --reads-only.
+# Controller commands (log files, framing, subscriptions) are never replayed.
+import sys
+import json
+import time
+import socket
+import datetime
+import threading
+import dispatch
+import bench
+
+def _parse_line(l):
+    # returns (client, time, message) of a log line, None for other lines.
+    i1 = l.find('), ')
+    if l[:1] != '(' or i1 == -1: return None
+    client, rest = l[:i1+1], l[i1+3:]
+    i2 = rest.find(': ')
+    if i2 == -1: return None
+    try: t = datetime.datetime.strptime(rest[:i2], '%Y-%m-%d %H:%M:%S,%f')
+    except ValueError: return None
+    return client, t, rest[i2+2:].rstrip('\n')
+
+def parse(fname, reads_only=False):
+    # returns the sessions in the log, a session is a list of
+    # [time (s), bundle, recorded reply or None], in the order sent.
+    sessions, open_ = [], {}
+    for l in open(fname):
+        p = _parse_line(l)
+        if p is None: continue
+        client, t, msg = p
+        t = (t - datetime.datetime(1970, 1, 1)).total_seconds()
+        if msg[:17] == 'Started talking t' or client not in open_:
+            open_[client] = {'reqs': [], 'pending': []}
+            sessions.append(open_[client]['reqs'])
+        s = open_[client]
+        if msg[:1] != '[': continue
+        try: b = json.loads(msg)
+        except ValueError: continue
+        if not isinstance(b, list) or len(b) == 0: continue
+        if all('status' not in x for x in b):
+            r = [t, b, None]
+            s['reqs'].append(r)
+            s['pending'].append(r)
+        elif len(s['pending']) > 0: s['pending'].pop(0)[2] = b
+    out = []
+    for reqs in sessions:
+        rs = []
+        for t, b, rep in reqs:
+            keep = [i for i, x in enumerate(b) if x.get('dev') != 'controller' and
+                    (not reads_only or dispatch.readonly(x.get('cmd', '')))]
+            if len(keep) == 0: continue
+            rs.append([t, [b[i] for i in keep],
+                [rep[i] for i in keep] if rep is not None and len(rep) == len(b) else None])
+        if len(rs) > 0: out.append(rs)
+    return out
+
+def compare(rec, res, diffs):
+    # counts the differences between the recorded and replayed replies.
+    if rec is None: return
+    if len(rec) != len(res) or any(x.get('dev') != y.get('dev') or x.get('cmd') != y.get('cmd')
+            for x, y in zip(rec, res)):
+        diffs.append(('shape', rec, res))
+        return
+    for x, y in zip(rec, res):
+        if x.get('status') != y.get('status'): diffs.append(('status', x, y))
+        elif len(x.get('value', [])) != len(y.get('value', [])): diffs.append(('shape', x, y))
+        elif x.get('value') != y.get('value'):
+            if dispatch.readonly(x.get('cmd', '')): diffs.append(('read value', x, y))
+            else: diffs.append(('value', x, y))
+
+def replay_session(address, reqs, t_start, t0, speed, lat, diffs, errors):
+    s = socket.create_connection(address)
+    f = s.makefile()
+    for t, b, rec in reqs:
+        if speed > 0:
+            dt = t_start + (t - t0)/speed - time.time()
+            if dt > 0: time.sleep(dt)
+        t1 = time.time()
+        try:
+            s.sendall(json.dumps(b)+'\n')
+            res = json.loads(f.readline())
+        except (socket.error, ValueError):
+            errors.append('connection')
+            return
+        lat.append(time.time() - t1)
+        compare(rec, res, diffs)
+    s.close()
+
+def replay(sessions, address, speed):
+    lat, diffs, errors = [], [], []
+    t0 = min(reqs[0][0] for reqs in sessions)
+    t_start = time.time() + 0.1
+    ths = [threading.Thread(target=replay_session,
+            args=(address, reqs, t_start, t0, speed, lat, diffs, errors)) for reqs in sessions]
+    for th in ths: th.start()
+    for th in ths: th.join()
+    return lat, diffs, errors, time.time() - t_start
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Replays the requests in a control server log.')
+    parser.add_argument('log', help='log file of the control server.')
+    parser.add_argument('--speed', type=float, default=1.0,
+            help='speed up of the recorded timing, 0 sends as fast as possible.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9999)
+    parser.add_argument('--reads-only', action='store_true', help='leave out the commands which aren\'t reads.')
+    parser.add_argument('--emulated', action='store_true',
+            help='start a control server on emulated devices (see bench.py) and replay to it.')
+    opts, server_args = parser.parse_known_args()
+
+    sessions = parse(opts.log, opts.reads_only)
+    n = sum(len(r) for r in sessions)
+    if n == 0:
+        print 'No requests in', opts.log
+        sys.exit(1)
+    span = max(r[-1][0] for r in sessions) - min(r[0][0] for r in sessions)
+    print '%d bundles on %d connections over %.1f s in the log'%(n, len(sessions), span)
+    address, p = (opts.host, opts.port), None
+    if opts.emulated:
+        p, rundir = bench.start_server(server_args)
+        address = bench.address
+    try: lat, diffs, errors, elapsed = replay(sessions, address, opts.speed)
+    finally:
+        if p is not None:
+            p.terminate()
+            p.wait()
+
+    lat.sort()
+    print '%d bundles in %.1f s, %.1f bundles/s, %d connection errors'%(len(lat), elapsed,
+            len(lat)/max(elapsed, 1e-6), len(errors))
+    print 'latency ms: p50 %.1f  p90 %.1f  p99 %.1f  max %.1f'%tuple(
+            bench.percentile(lat, p)*1000 for p in [50, 90, 99, 100])
+    kinds = {}
+    for d in diffs: kinds[d[0]] = kinds.get(d[0], 0) + 1
+    print 'differences from the log:', ', '.join('%s %d'%(k, v) for k, v in sorted(kinds.iteritems())) or 'none'
+    for k, rec, res in [d for d in diffs if d[0] != 'read value'][:10]:
+        print '  %s: recorded %s, replayed %s'%(k, json.dumps(rec), json.dumps(res))
@@ -22,6 +22,7 @@ def funcmap(devname, devid):
 
 
 import threading
+import tracer
 # timeout = 0.025 is minimum to not give communication errors. Raising it to larger values
 # increases the response times, for example at 0.1 s timeout, get_pressure_position is
 # returned in 240 ms, whereas it takes ~112 ms at 0.03 timeout (~105 ms at 0.025 timeout).
@@ -49,12 +50,20 @@ _cmd_status = bidict({'0': 'No error', '1': 'Unrecognised command', '2': 'Bad da
 def _cmd_io(cmdstr, eps=50):
     res = ''
     with chan_d['tvc']['lock']:
-        chan_d['tvc']['port'].write(_cmd_mod+cmdstr+'\n')
-        if eps==0: return
-        else: res = chan_d['tvc']['port'].read(eps)[:-1]
-    #if len(res)==0: # time out occurred
-    #    raise TVC_Error('Timeout occurred', '')
-    if res[0] != '0': raise TVC_Error(_cmd_status[res[0]], res)
+        port = chan_d['tvc']['port']
+        tracer.begin(port)
+        err = None
+        try:
+            port.write(_cmd_mod+cmdstr+'\n')
+            if eps==0: return
+            else: res = port.read(eps)[:-1]
+            #if len(res)==0: # time out occurred
+            #    raise TVC_Error('Timeout occurred', '')
+            if res[0] != '0': raise TVC_Error(_cmd_status[res[0]], res)
+        except Exception as e:
+            err = repr(e)
+            raise
+        finally: tracer.end(port, err)
     return res[1:]
 
 
@@ -96,17 +105,30 @@ class sierra_mfc():
         return 'xxxx0.0'
         res, c = '', None
         with self.io['lock']:
-            cmdstr = cmdstr + self.lrc(cmdstr)+'\r\n'
-            self.io['port'].write(cmdstr)
-            while c!='\n':
-                c = self.io['port'].read()
-                res += c
+            port = self.io['port']
+            tracer.begin(port)
+            err = None
+            try:
+                cmdstr = cmdstr + self.lrc(cmdstr)+'\r\n'
+                port.write(cmdstr)
+                while c!='\n':
+                    c = port.read()
+                    res += c
+            except Exception as e:
+                err = repr(e)
+                raise
+            finally: tracer.end(port, err)
         # we don't do LRC check on return values.
         return res[:-4]
     def init_state(self, args):
         self.fs_range, self.curr_setp = args['fs_range'], args['init_val']
-        self.set_flow([self.curr_setp])
+        # the setpoint is written only if the mfc has another one.
+        try: same = abs(self.get_setp() - self.curr_setp) < 0.05
+        except ValueError: same = False
+        if not same: self.set_flow([self.curr_setp])
         self.get_flow([])
+    def get_setp(self):
+        return float(self.cmd_io('?Setr')[4:])
     def set_flow(self, args):
         s = float(args[0])
         if 0 <= s <= self.fs_range: 
@@ -162,11 +184,15 @@ class tvc():
     def init_state(self, args):
         # open or close the valve
         if args['manual-setp']=='Open': _valve_open()
-        # set the sensor ranges
-        if args['reset_sensor_range']:
-            _set_sensor_high_range(args['high_sensor_fs_range'])
-            _set_sensor_low_range(args['low_sensor_fs_range'])
+        # set the sensor ranges, this goes through the calibration mode, so
+        # only the ones which are different are set.
         self.get_sensor_ranges([])
+        if args['reset_sensor_range']:
+            if self.high_fs != float(args['high_sensor_fs_range']):
+                _set_sensor_high_range(str(args['high_sensor_fs_range']))
+            if self.low_fs != float(args['low_sensor_fs_range']):
+                _set_sensor_low_range(str(args['low_sensor_fs_range']))
+            self.get_sensor_ranges([])
         # see if slowpump is enabled, set accordingly.
         self.slowpump = args['slowpump']
         #_set_slowpump_rate(self.slowpump['rate'])
@@ -174,12 +200,15 @@ class tvc():
         #_set_slowpump_pressure(self.slowpump['pressure'])
         # set safety state
         self.fallback_state = args['fallback_state']
-        _set_ss(self.fallback_state)
+        try: same = _get_ss()['Valve safety state'] == self.fallback_state
+        except (KeyError, IndexError, TVC_Error): same = False
+        if not same: _set_ss(self.fallback_state)
         # set crossover parameters
-        #get and set the setpoint values
+        #get and set the setpoint values, only those which are different are
+        #written (a restart during a run then doesn't touch the valve).
         for s in args['setpoints']:
             self.setps[s[0]] = s[1:]
-            _set_setp_values(s[0], self.setps[s[0]])
+            _update_setp_values(s[0], self.setps[s[0]])
         # activate a setpoint if needed
         if args['actv_setpoint'] != 'manual': self.activate_setp(args['actv_setpoint'])
         #self.get_actv_setp_ch([])
@@ -511,6 +540,12 @@ def _set_setp_values(s, v, brief=True):
     if brief: return [_set_setp_mode(s, v[0]), _set_setp_value(s, v[1]), _set_softstart_rate(s, v[2])]
     else: return [_set_setp_mode(s, v[0]), _set_setp_value(s, v[1]), _set_softstart_rate(s, v[2]),\
             _set_setp_gain(s, v[3]), _set_setp_phase(s, v[4])]
+def _update_setp_values(s, v):
+    cur = _get_setp_values(s)
+    same = lambda x, y: isinstance(x, float) and abs(x - float(y)) < 0.01
+    if cur[0] != v[0]: _set_setp_mode(s, v[0])
+    if not same(cur[1], v[1]): _set_setp_value(s, v[1])
+    if not same(cur[2], v[2]): _set_softstart_rate(s, v[2])
 def _activate_setp(spoint):
     try: return _cmd_io('D'+_setp_ctrl_resp[:spoint])[1]
     except: return 'Setpoints are A|B|C|D|E|analog. Given:'+spoint
@@ -35,6 +35,8 @@ _tm_o = {115200: 0.002, 9600: 0.01}
 # too many errors and long delays at lower BR
 
 import threading
+import tracer
+import devconfig
 chan_d = {'lock':threading.RLock(), 'portname':'/dev/ttyS0', 'port': None, 'cbr': 115200, 'timeout':_tm_o[115200], 'error_attempts':100}
 # better not to use the probing of br, since in case of noise (at present) 
 # 9600 bauds will be picked up, which is not good. for best results use:
@@ -49,9 +51,14 @@ def port_close(): chan_d['port'].close()
 def init_comm(): 
     # following is done to avoid communication errors
     # ideally it should work with set_port(port_open()) only
+    # the devices which already answer at 115200 are left as they are.
+    set_port(port_open())
+    macids = sorted(set(chr(v['devid']) for v in devconfig.devlist.itervalues() if v['conn'] == 'rs485'))
+    macids = [m for m in macids if not at_cbr(m)]
+    if len(macids) == 0: return
+    port_close()
     set_port(port_open(br=9600))
-    set_cbr(chr(32), br=115200)
-    set_cbr(chr(33), br=115200)
+    for m in macids: set_cbr(m, br=115200)
     port_close()
     set_port(port_open())
 
@@ -66,8 +73,12 @@ class brooks_mfc():
         self.name, self.macid = name, chr(macid)
     def init_state(self, args):
         self.fs_range, self.curr_setp = args['fs_range'], args['init_val']
-        set_cbr(self.macid, br=chan_d['cbr'])
-        self.set_flow([self.curr_setp])
+        # the baud rate and setpoint are written only if they are different.
+        if not at_cbr(self.macid): set_cbr(self.macid, br=chan_d['cbr'])
+        try: same = abs(get_filtered_setp(self.macid, self.fs_range) - self.curr_setp) <= \
+                self.fs_range/0x8000
+        except (MFC_Error, struct.error, IndexError): same = False
+        if not same: self.set_flow([self.curr_setp])
         self.get_flow([])
     def set_flow(self, args):
         s = float(args[0])
@@ -133,38 +144,45 @@ def cmd_io(cmdstr, pkt_sz, monitor_attempts=False, attempts=chan_d['error_attemp
     if _DEBUG: print 'Sending(', len(cmdstr), '): ', to_hex(cmdstr), '. Expecting', pkt_sz, 'bytes.'
     c, s, i, a = '', '', 0, attempts
     with _LOCK:
-        while not monitor_attempts or a > 0: # loop till correct resp (positive or negative is reached)
-            a -= 1
+        tracer.begin(_PORT)
+        err = None
+        try:
+            while not monitor_attempts or a > 0: # loop till correct resp (positive or negative is reached)
+                if a != attempts: tracer.retry(_PORT)
+                a -= 1
+                _PORT.write(_ACK)
+                c, s, i = '', '', 0
+                _PORT.write(cmdstr)
+                while c=='' and i<3: #3 is arbitrary
+                    try: c = _PORT.read(100) # read as much as it yields, 100 is arbitrary
+                    except (serial.serialutil.SerialException, OSError): pass
+                    i += 1
+                if c=='': continue
+                if _DEBUG: print 'Ack(trials:',i,')', to_hex(c), '[len:', len(c), ']'
+                # most of the times correct response is received with ACK token, so,
+                c, s = find_ack(c)
+                #_PORT.write(_ACK)
+                # pkt_Sz is only indicator of max response sent by the device.
+                i = 0
+                while len(s)<pkt_sz and i<3: # 3 is arbitrary
+                    try: s += _PORT.read(pkt_sz)
+                    except (serial.serialutil.SerialException, OSError): pass
+                    i += 1
+                if _DEBUG: print 'resp(trials:',i,')', to_hex(s), '[len:', len(s), ']'
+                if s=='': continue # no resp! query again.
+                # if c earlier had fragments from earlier unsuccessful run, then it is '' now
+                # so, read it again from s. if not found, s = c = '', which will lead to query again.
+                elif c!=_ACK and c!=_NAK: c, s = find_ack(s)
+                if len(s) >= pkt_sz: break
+            if _DEBUG: print 'Queries made:', attempts-a
+            if monitor_attempts and a == 0: raise MFC_Error("No response")
+            if c == _NAK: raise MFC_Error("Command incorrect.")
+            if s[0] == _NAK: raise MFC_Error("Failed to process command.")
             _PORT.write(_ACK)
-            c, s, i = '', '', 0
-            _PORT.write(cmdstr)
-            while c=='' and i<3: #3 is arbitrary
-                try: c = _PORT.read(100) # read as much as it yields, 100 is arbitrary
-                except (serial.serialutil.SerialException, OSError): pass
-                i += 1
-            if c=='': continue
-            if _DEBUG: print 'Ack(trials:',i,')', to_hex(c), '[len:', len(c), ']'
-            # most of the times correct response is received with ACK token, so,
-            c, s = find_ack(c)
-            #_PORT.write(_ACK)
-            # pkt_Sz is only indicator of max response sent by the device.
-            i = 0
-            while len(s)<pkt_sz and i<3: # 3 is arbitrary
-                try: s += _PORT.read(pkt_sz)
-                except (serial.serialutil.SerialException, OSError): pass
-                i += 1
-            if _DEBUG: print 'resp(trials:',i,')', to_hex(s), '[len:', len(s), ']'
-            if s=='': continue # no resp! query again.
-            # if c earlier had fragments from earlier unsuccessful run, then it is '' now
-            # so, read it again from s. if not found, s = c = '', which will lead to query again.
-            elif c!=_ACK and c!=_NAK: c, s = find_ack(s)
-            if len(s) >= pkt_sz: break
-    
-        if _DEBUG: print 'Queries made:', attempts-a
-        if monitor_attempts and a == 0: raise MFC_Error("No response")
-        if c == _NAK: raise MFC_Error("Command incorrect.")
-        if s[0] == _NAK: raise MFC_Error("Failed to process command.")
-        _PORT.write(_ACK)
+        except Exception as e:
+            err = repr(e)
+            raise
+        finally: tracer.end(_PORT, err)
     return s
 
 def get_macid(devid):
@@ -182,6 +200,14 @@ def get_cbr(devid):
     cmd = form_cmd(devid, _R, ('\x03', '\x01', '\x65'), '')
     func, d = parse_resp(cmd_io(cmd, _mps + 4))
     return to_int(d)
+# true if the device answers at the baud rate of the port (chan_d['cbr']),
+# it is asked only a few times.
+def at_cbr(devid):
+    cmd = form_cmd(devid, _R, ('\x03', '\x01', '\x65'), '')
+    try: func, d = parse_resp(cmd_io(cmd, _mps + 4, monitor_attempts=True, attempts=5))
+    except (MFC_Error, IndexError): return False
+    try: return to_int(d) == chan_d['cbr']
+    except struct.error: return False
 def set_cbr(devid, br):
     cmd = form_cmd(devid, _W, ('\x03', '\x01', '\x65'), from_int(br))
     try:
@@ -0,0 +1,82 @@
+# latency statistics of the commands run on the channels.
+#
+# The channel workers (dispatch.Executor) report every command they run:
+# how long it waited in the queue for the channel and how long it took on
+# the bus. These are kept per (device, command) and per channel as counts,
+# errors and latency histograms, and can be seen with
+#   [{"dev": "controller", "cmd": "stats", "args": [""]}]
+# or with "args": ["reset"] to also start afresh.
+import threading
+import time
+
+# upper bounds of the histogram buckets in ms, the last bucket is for the rest.
+bounds_ms = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+class Stat():
+    def __init__(self):
+        self.count, self.errors = 0, 0
+        self.total, self.max, self.wait, self.max_wait = 0.0, 0.0, 0.0, 0.0
+        self.hist = [0]*(len(bounds_ms)+1)
+
+    def add(self, wait, dt, error):
+        self.count += 1
+        if error: self.errors += 1
+        self.total += dt
+        self.wait += wait
+        self.max, self.max_wait = max(self.max, dt), max(self.max_wait, wait)
+        ms, i = dt*1000, 0
+        while i < len(bounds_ms) and ms > bounds_ms[i]: i += 1
+        self.hist[i] += 1
+
+    def percentile(self, p):
+        # the p'th percentile in ms, interpolated within the bucket which has
+        # it, and no more than the slowest command.
+        """
+        >>> s = Stat()
+        >>> for dt in [0.101, 0.102, 0.104]: s.add(0.0, dt, False)
+        >>> s.percentile(50), s.percentile(99) <= s.summary()['max_ms']
+        (102.0, True)
+        """
+        n, k, top = 0, p*self.count/100.0, self.max*1000
+        for i, h in enumerate(self.hist):
+            n += h
+            if n >= k and n > 0:
+                hi = min(bounds_ms[i], top) if i < len(bounds_ms) else top
+                lo = min(bounds_ms[i-1], hi) if i > 0 else 0.0
+                return round(lo + (hi-lo)*(k-(n-h))/h, 1)
+        return 0
+
+    def summary(self):
+        n = max(self.count, 1)
+        labels = ['<=%dms'%(b) for b in bounds_ms] + ['>%dms'%(bounds_ms[-1])]
+        return {'count': self.count, 'errors': self.errors,
+            'mean_ms': round(self.total*1000/n, 2), 'max_ms': round(self.max*1000, 2),
+            'p50_ms': self.percentile(50), 'p99_ms': self.percentile(99),
+            'wait_mean_ms': round(self.wait*1000/n, 2), 'wait_max_ms': round(self.max_wait*1000, 2),
+            'hist': dict((l, h) for l, h in zip(labels, self.hist) if h > 0)}
+
+class Stats():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.devs, self.chans, self.since = {}, {}, time.time()
+
+    def add(self, chan, tag, wait, dt, error):
+        # tag is (dev, cmd)
+        with self.lock:
+            for d, k in [(self.chans, chan), (self.devs, ' '.join(tag))]:
+                if k not in d: d[k] = Stat()
+                d[k].add(wait, dt, error)
+
+    def summary(self):
+        with self.lock:
+            return {'since': self.since,
+                'devices': dict((k, v.summary()) for k, v in self.devs.iteritems()),
+                'channels': dict((k, v.summary()) for k, v in self.chans.iteritems())}
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
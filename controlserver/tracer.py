@@ -0,0 +1,118 @@
+# tracer of the bus transactions, off by default.
+#
+# When it is turned on (controller command trace, see controlserver.py), the
+# ports of the channels are replaced by TracedPort wrappers which time every
+# write and read. The cmd_io functions of the channel modules mark where a
+# transaction begins and ends and when it is retried, so a transaction has
+#   channel, bytes written, bytes read, write start, write end, first byte
+#   received, completion, number of retries and the error it failed with
+# (times in seconds of the monotonic clock of logwriter.py). LabJack calls
+# are not byte streams, for them each call is a transaction with its name,
+# args and result. The transactions are kept in a ring buffer which can be
+# dumped to a file (one json object per line) for looking at offline.
+#
+# When the tracer is off the ports are not wrapped, and begin/retry/end only
+# check the type of the port they are given.
+import collections
+import json
+from logwriter import monotonic
+
+ring = collections.deque(maxlen=10000)
+enabled = False
+
+def _hex(chunks): return ':'.join('%02x'%(ord(c)) for c in ''.join(chunks))
+
+class TracedPort(object):
+    def __init__(self, port, chan):
+        self._port, self._chan, self._tr = port, chan, None
+
+    def _new(self):
+        return {'chan': self._chan, 'written': [], 'read': [], 'retries': 0,
+            't_write_start': None, 't_write_end': None, 't_first_byte': None, 't_done': None}
+
+    def begin(self): self._tr = self._new()
+
+    def retry(self):
+        if self._tr is not None: self._tr['retries'] += 1
+
+    def end(self, error=None):
+        tr, self._tr = self._tr, None
+        if tr is None: return
+        if error is not None: tr['error'] = error
+        self._save(tr)
+
+    def _save(self, tr):
+        tr['t_done'] = monotonic()
+        tr['written'], tr['read'] = _hex(tr['written']), _hex(tr['read'])
+        ring.append(tr)
+
+    def _current(self):
+        # writes/reads outside of begin/end are traced one by one.
+        if self._tr is not None: return self._tr, False
+        return self._new(), True
+
+    def write(self, data):
+        tr, single = self._current()
+        t0 = monotonic()
+        n = self._port.write(data)
+        t1 = monotonic()
+        if tr['t_write_start'] is None: tr['t_write_start'] = t0
+        tr['t_write_end'] = t1
+        tr['written'].append(data)
+        if single: self._save(tr)
+        return n
+
+    def read(self, size=1):
+        tr, single = self._current()
+        d = self._port.read(size)
+        if d and tr['t_first_byte'] is None: tr['t_first_byte'] = monotonic()
+        tr['read'].append(d)
+        if single: self._save(tr)
+        return d
+
+    def __getattr__(self, name):
+        a = getattr(self._port, name)
+        if not callable(a): return a
+        def traced_call(*args, **kw):
+            tr = {'chan': self._chan, 'call': name, 'args': repr(args)[:200], 't_start': monotonic()}
+            try:
+                r = a(*args, **kw)
+                tr['result'] = repr(r)[:200]
+                return r
+            except Exception as e:
+                tr['error'] = repr(e)
+                raise
+            finally:
+                tr['t_done'] = monotonic()
+                ring.append(tr)
+        return traced_call
+
+# these are called from the cmd_io functions, end in a finally with the
+# error (repr) of a transaction which has failed.
+def begin(port):
+    if isinstance(port, TracedPort): port.begin()
+def retry(port):
+    if isinstance(port, TracedPort): port.retry()
+def end(port, error=None):
+    if isinstance(port, TracedPort): port.end(error)
+
+def enable(slots, size=None):
+    # slots is a list of (channel name, dict having the 'port' of the channel).
+    global ring, enabled
+    if size is not None and size != ring.maxlen: ring = collections.deque(ring, maxlen=size)
+    for chan, d in slots:
+        if d['port'] is not None and not isinstance(d['port'], TracedPort):
+            d['port'] = TracedPort(d['port'], chan)
+    enabled = True
+
+def disable(slots):
+    global enabled
+    for chan, d in slots:
+        if isinstance(d['port'], TracedPort): d['port'] = d['port']._port
+    enabled = False
+
+def dump(fname):
+    trs = list(ring)
+    with open(fname, 'w') as f:
+        for tr in trs: f.write(json.dumps(tr)+'\n')
+    return len(trs)
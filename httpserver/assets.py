@@ -0,0 +1,71 @@
+# the files under /static (public/), compressed once and validated by ETag.
+#
+# A file is read and gzipped the first time it is asked for, and kept with the
+# sha1 of its contents until its mtime or size changes. The browsers get the
+# gzipped copy if they take gzip, a strong ETag for each copy and a long
+# max-age, and 304 Not Modified with no body when they send back the ETag of
+# the copy they have. So jquery, flot etc. are sent to a lab PC once, and only
+# compressed.
+import os
+import gzip
+import hashlib
+import mimetypes
+import threading
+import cStringIO
+
+# compressing these doesn't gain anything.
+_compressed = ['image/png', 'image/jpeg', 'image/gif', 'application/zip', 'application/x-gzip']
+
+class Assets():
+    def __init__(self, root, maxage=7*24*3600):
+        self.root, self.maxage = os.path.abspath(root), maxage
+        self.lock, self.files = threading.Lock(), {}
+
+    def _load(self, fname, st):
+        data = open(fname, 'rb').read()
+        ctype = mimetypes.guess_type(fname)[0] or 'application/octet-stream'
+        gz = None
+        if ctype not in _compressed:
+            buf = cStringIO.StringIO()
+            f = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0)
+            f.write(data)
+            f.close()
+            if buf.tell() < len(data): gz = buf.getvalue()
+        h = hashlib.sha1(data).hexdigest()
+        return {'key': (st.st_mtime, st.st_size), 'type': ctype, 'mtime': st.st_mtime,
+            'data': data, 'gz': gz, 'etag': '"%s"'%(h), 'etag_gz': '"%s-gz"'%(h)}
+
+    def get(self, path):
+        # path is relative to root, returns the entry of the file or None.
+        fname = os.path.normpath(os.path.join(self.root, path))
+        if not fname.startswith(self.root+os.sep): return None
+        try: st = os.stat(fname)
+        except OSError: return None
+        if not os.path.isfile(fname): return None
+        with self.lock: e = self.files.get(fname)
+        if e is None or e['key'] != (st.st_mtime, st.st_size):
+            e = self._load(fname, st)
+            with self.lock: self.files[fname] = e
+        return e
+
+    def respond(self, e, accept_encoding, if_none_match):
+        # returns (status, headers, body) for the request headers given.
+        gz = e['gz'] is not None and _takes_gzip(accept_encoding)
+        etag = e['etag_gz'] if gz else e['etag']
+        headers = {'Content-Type': e['type'], 'ETag': etag, 'Vary': 'Accept-Encoding',
+            'Cache-Control': 'public, max-age=%d'%(self.maxage)}
+        if etag in [x.strip() for x in (if_none_match or '').split(',')]:
+            return 304, headers, ''
+        if gz:
+            headers['Content-Encoding'] = 'gzip'
+            return 200, headers, e['gz']
+        return 200, headers, e['data']
+
+def _takes_gzip(accept_encoding):
+    for x in (accept_encoding or '').split(','):
+        p = [y.strip() for y in x.split(';')]
+        if p[0] not in ['gzip', '*']: continue
+        q = [y[2:] for y in p[1:] if y[:2] == 'q=']
+        try: return len(q) == 0 or float(q[0]) > 0
+        except ValueError: return False
+    return False
@@ -0,0 +1,60 @@
+# pool of connections to the control server, shared by the cherrypy worker
+# threads.
+#
+# A connection is used by one request at a time (the control server answers
+# the bundles of a connection in order), so parallel requests from the
+# browsers go on different connections, up to size of them, the others wait
+# for one to be free. The connections are made when they are first needed and
+# kept open. One which has been idle is checked before it is used again, a
+# connection closed by the control server (e.g. it has been restarted) is
+# readable with nothing to read, it is thrown away and a new one is made.
+# If the control server can't be reached, or goes away in the middle of a
+# request, the reply is an error in the form the control server uses.
+import json
+import time
+import Queue
+import select
+import socket
+
+class Pool():
+    def __init__(self, address, size=10, timeout=30.0, check_after=1.0):
+        # timeout is for a reply from the control server, check_after is how
+        # long a connection can be idle before it is checked.
+        self.address, self.timeout, self.check_after = address, timeout, check_after
+        self.free = Queue.LifoQueue()
+        for i in range(size): self.free.put(None)
+
+    def _connect(self):
+        s = socket.create_connection(self.address, timeout=5.0)
+        s.settimeout(self.timeout)
+        return [s, s.makefile(), time.time()]
+
+    def _healthy(self, c):
+        if time.time() - c[2] < self.check_after: return True
+        try: r, w, x = select.select([c[0]], [], [], 0)
+        except (select.error, socket.error): return False
+        # nothing is sent by the control server between the replies.
+        return len(r) == 0
+
+    def _close(self, c):
+        try: c[0].close()
+        except socket.error: pass
+
+    def request(self, d):
+        # sends the bundle d and returns the reply line.
+        c = self.free.get()
+        try:
+            if c is not None and not self._healthy(c):
+                self._close(c)
+                c = None
+            if c is None: c = self._connect()
+            c[0].sendall(json.dumps(d)+'\n')
+            r = c[1].readline()
+            if r == '': raise socket.error('Connection closed by the control server')
+            c[2] = time.time()
+            return r
+        except socket.error as e: # socket.timeout is one too.
+            if c is not None: self._close(c)
+            c = None
+            return json.dumps([{'status': 'Error', 'error': 'controlserver: '+repr(e)}])+'\n'
+        finally: self.free.put(c)
@@ -0,0 +1,73 @@
+# the live samples for the browsers, as server-sent events (/events in
+# httpserver.py).
+#
+# There is one subscription to the control server (see poller.Subscription in
+# controlserver), whatever the number of browsers watching. Each sample line
+# it pushes is made into an event once, and the same string is queued for
+# every browser, so the work per sample doesn't grow with the viewers. A
+# browser which doesn't keep up misses samples, it doesn't hold up the
+# others. If the control server goes away, the feed connects again.
+import json
+import time
+import Queue
+import socket
+import threading
+
+class Feed(threading.Thread):
+    def __init__(self, address, interval=1.0, maxviewers=20, maxq=10):
+        threading.Thread.__init__(self, name='feed')
+        self.daemon = True
+        self.address, self.interval = address, interval
+        self.maxviewers, self.maxq = maxviewers, maxq
+        self.lock, self.viewers = threading.Lock(), []
+
+    def run(self):
+        while True:
+            try: self._follow()
+            except (socket.error, ValueError, KeyError, IndexError): pass
+            time.sleep(1.0)
+
+    def _follow(self):
+        s = socket.create_connection(self.address, timeout=5.0)
+        # a sample is pushed every interval, none for long means it is stuck.
+        s.settimeout(max(10.0, 10*self.interval))
+        try:
+            f = s.makefile()
+            s.sendall(json.dumps([{'dev': 'controller', 'cmd': 'subscribe', 'args': [''],
+                'interval': self.interval}])+'\n')
+            r = json.loads(f.readline())[0]
+            if r['status'] != 'OK': raise ValueError(r['value'])
+            while True:
+                l = f.readline()
+                if l == '': return
+                self._publish('data: '+l.strip()+'\n\n')
+        finally: s.close()
+
+    def _publish(self, ev):
+        with self.lock: vs = self.viewers[:]
+        for q in vs:
+            try: q.put_nowait(ev)
+            except Queue.Full: pass
+
+    def listen(self):
+        # returns the queue of a new viewer, None if there are maxviewers.
+        with self.lock:
+            if len(self.viewers) >= self.maxviewers: return None
+            if not self.is_alive(): self.start()
+            q = Queue.Queue(self.maxq)
+            self.viewers.append(q)
+        return q
+
+    def leave(self, q):
+        with self.lock:
+            if q in self.viewers: self.viewers.remove(q)
+
+    def stream(self, q, keepalive=15.0):
+        # the body of a viewer's response. The comments sent when there is
+        # nothing else find out the browsers which have gone away.
+        try:
+            yield 'retry: 2000\n\n'
+            while True:
+                try: yield q.get(timeout=keepalive)
+                except Queue.Empty: yield ': keepalive\n\n'
+        finally: self.leave(q)
@@ -4,14 +4,29 @@ import json
 import random
 
 
-import socket
-cnt = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-cnt.connect(('127.0.0.1', 9999))
-cntfile = cnt.makefile()
+# the requests of the cherrypy worker threads go to the control server over a
+# pool of connections (see connpool.py), one per worker at most.
+import connpool
+controlserver = ('127.0.0.1', 9999)
+pool_size = 10 # cherrypy's server.thread_pool
+pool = connpool.Pool(controlserver, pool_size)
+# the bundles of reads are answered from a cache for the time below (the
+# shortest one of their commands), see respcache.py. The other commands empty
+# it, reads not listed aren't cached.
+import respcache
+cache_ttls = {'get_flow': 0.2, 'get_pressure_position': 0.2, 'get_state': 0.5, 'get_fs_range': 5.0}
+cache = respcache.Cache(cache_ttls)
 def command_handler(d):
-    global cnt, cntfile
-    cnt.send(json.dumps(d)+'\n')
-    return cntfile.readline()
+    return cache.request(d, pool.request)
+
+# the polled samples are pushed to the browsers from one subscription to the
+# control server (see feed.py). A viewer keeps a cherrypy worker thread for
+# as long as it watches, so there are max_viewers more threads than
+# connections in the pool.
+import feed
+feed_interval = 1.0
+max_viewers = 20
+samples = feed.Feed(controlserver, feed_interval, max_viewers)
 
 def dummy_command_handler(d):
     r = {}
@@ -21,6 +36,20 @@ def dummy_command_handler(d):
     return json.dumps(r)
 
 import cherrypy
+import cherrypy.lib.sessions
+
+# sessions are kept in memory, for timeout minutes (cherrypy's RamSession),
+# and at most maxsize of them: the ones closest to expiring are dropped to
+# make room. cherrypy finds the class by storage_type, as <Type>Session.
+class MemSession(cherrypy.lib.sessions.RamSession):
+    maxsize = 1000
+    def _save(self, expiration_time):
+        if self.id not in self.cache and len(self.cache) >= self.maxsize:
+            old = sorted(self.cache.items(), key=lambda x: x[1][1])
+            for id, (data, t) in old[:len(self.cache) - self.maxsize + 1]:
+                self.cache.pop(id, None)
+        cherrypy.lib.sessions.RamSession._save(self, expiration_time)
+cherrypy.lib.sessions.MemSession = MemSession
 
 class FurnaceControl(object):
     @cherrypy.expose
@@ -54,6 +83,32 @@ class FurnaceController(object):
         #cherrypy.session['mystring'] = another_string
         #cherrypy.session.pop('mystring', None)
 
+# text/event-stream of the samples, {"t": .., "samples": [..]} in each event.
+class Events(object):
+    @cherrypy.expose
+    def index(self):
+        q = samples.listen()
+        if q is None: raise cherrypy.HTTPError(503, 'Too many viewers')
+        cherrypy.response.headers['Content-Type'] = 'text/event-stream'
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+        return samples.stream(q)
+
+# the files in public/, gzipped once and cached by the browsers (see assets.py).
+import assets
+class Static(object):
+    def __init__(self, root):
+        self.assets = assets.Assets(root)
+
+    @cherrypy.expose
+    def default(self, *path):
+        e = self.assets.get(os.path.join(*path)) if len(path) > 0 else None
+        if e is None: raise cherrypy.NotFound()
+        h = cherrypy.request.headers
+        status, headers, body = self.assets.respond(e, h.get('Accept-Encoding'), h.get('If-None-Match'))
+        cherrypy.response.status = status
+        cherrypy.response.headers.update(headers)
+        return body
+
 from readlog import get_plotdata
 
 class Logs(object):
@@ -117,47 +172,59 @@ if __name__ == '__main__':
             'log.access_file': os.path.abspath(os.getcwd())+'/access_log.txt',
             'log.error_file': os.path.abspath(os.getcwd())+'/error_log.txt',
             'server.socket_port': 8080,
-            'server.socket_host': '0.0.0.0'
+            'server.socket_host': '0.0.0.0',
+            'server.thread_pool': pool_size + max_viewers
             },
         '/': {
+            # the pages and the json replies (sent as text/plain) are gzipped.
+            'tools.gzip.on': True,
+            'tools.gzip.mime_types': ['text/html', 'text/plain', 'application/json'],
             'tools.sessions.on': True,
-            'tools.sessions.storage_type': "file",
-            'tools.sessions.storage_path': os.path.abspath(os.getcwd())+'/sessions',
-            #tools.sessions.timeout = 60
+            'tools.sessions.storage_type': "mem",
+            'tools.sessions.timeout': 60,
             'tools.staticdir.root': os.path.abspath(os.getcwd())
         },
         '/generator': {
+            'tools.sessions.on': False,
             'request.dispatch': cherrypy.dispatch.MethodDispatcher(),
             'tools.response_headers.on': True,
             'tools.response_headers.headers': [('Content-Type', 'text/plain')],
         },
+        '/events': {
+            'tools.gzip.on': False,
+            'tools.sessions.on': False,
+            'response.stream': True,
+        },
         '/logs': {
             'tools.sessions.on': True,
-            'tools.sessions.storage_type': "file",
-            'tools.sessions.storage_path': os.path.abspath(os.getcwd())+'/sessions',
-            #tools.sessions.timeout = 60
+            'tools.sessions.storage_type': "mem",
+            'tools.sessions.timeout': 60,
             'tools.staticdir.root': os.path.abspath(os.getcwd())
         },
         '/loggenerator': {
+            'tools.sessions.on': False,
             'request.dispatch': cherrypy.dispatch.MethodDispatcher(),
             'tools.response_headers.on': True,
             'tools.response_headers.headers': [('Content-Type', 'text/plain')],
         },
         '/scripthandler': {
+            'tools.sessions.on': False,
             'request.dispatch': cherrypy.dispatch.MethodDispatcher(),
             'tools.response_headers.on': True,
             'tools.response_headers.headers': [('Content-Type', 'text/plain')],
         },
         '/static': {
-            'tools.staticdir.on': True,
-            'tools.staticdir.dir': './public'
+            'tools.gzip.on': False,
+            'tools.sessions.on': False,
         }
     }
     webapp = FurnaceControl()
     webapp.generator = FurnaceController()
+    webapp.events = Events()
     webapp.logs = Logs()
     webapp.loggenerator = LogGenerator()
     webapp.scripthandler = ScriptHandler()
+    webapp.static = Static(os.path.abspath(os.getcwd())+'/public')
     print """
     Connected to the controlserver and processing requests at http://localhost:8080.
     You can view logs at http://localhost:8080/logs/.
@@ -6,6 +6,7 @@ import pickle
 import numpy as np
 from collections import defaultdict
 import os
+import threading
 
 # change this to whereever the data is stored, e.g. datadir = './log/'
 datadir = '../controlserver/log/'
@@ -24,28 +25,43 @@ except:
 # The resulting files have '.processed' appeneded in filenames.
 # Filesize can be reduced 10 times further with compression (not done here
 # at the moment).
-def _pickle_logfiles(fnames):
+#
+# A log which is still being written is processed incrementally: the byte
+# offset up to which it has been read, and the times of its first and last
+# samples, are kept in '.processed.state' (json). The next run reads the log
+# from that offset (up to its last whole line) and appends the new samples to
+# the '.processed' file as another pickled {dev: array}, _loaddata joins them.
+# If the log has shrunk or the processed file isn't the one the state was
+# written with, the log is processed again from the start.
+_tfmt = '%Y-%m-%d %H:%M:%S,%f'
+_proc_lock = threading.Lock()
+
+def _parse_lines(logfile, t0):
+    # returns {dev: [[t, value], ..]}, t0, time of the last sample and the
+    # number of bytes of the whole lines read.
     flowdict = {'flow': 1, 'noflow':0}
     devdict = defaultdict(list)
-    for f in fnames:
-        logfile = open(f);
-
-        t0 = None
-        for l in logfile:
-            if l=='\n': continue
-            i1, i2 = l.find(')'), l.find('[')
-            if i2==-1: continue
-            ip, t, msg = l[:i1+1], strip(l[i1+2:i2-2]), l[i2:]
-            try: s = json.loads(msg)
-            except: pass
-            t = datetime.datetime.strptime(t, '%Y-%m-%d %H:%M:%S,%f')
-            #print ip, t, msg
-            if t0==None: t0 = t
-            tdiff = t-t0
-            tsec = tdiff.seconds + tdiff.microseconds/1E6
-            for d in s:
-                if 'status' not in d: continue
-                if d['status'] == 'Error': continue
+    last, n = None, 0
+    for l in logfile:
+        if l[-1:] != '\n': break # being written.
+        n += len(l)
+        if l=='\n': continue
+        i1, i2 = l.find(')'), l.find('[')
+        if i2==-1: continue
+        ip, t, msg = l[:i1+1], strip(l[i1+2:i2-2]), l[i2:]
+        try:
+            s = json.loads(msg)
+            t = datetime.datetime.strptime(t, _tfmt)
+        except ValueError: continue
+        #print ip, t, msg
+        if t0==None: t0 = t
+        last = t
+        tsec = (t-t0).total_seconds()
+        for d in s:
+            # only the successful replies have values ('Error', 'Timeout' of
+            # the deadlines etc. don't), 0 is the sierra mfc's OK.
+            if not isinstance(d, dict) or d.get('status') not in ('OK', 0): continue
+            try:
                 points = devdict[d['dev']]
                 if d['dev'][:2] == 'sw':
                     points.append([tsec, flowdict[d['value'][0]]])
@@ -56,27 +72,70 @@ def _pickle_logfiles(fnames):
                     if d['cmd'][:9] == 'get_press':
                         press, pos = map(float, split(d['value'][0], ','))
                         points.append([tsec, press])
+            except (KeyError, IndexError, ValueError, TypeError, AttributeError): continue
+    return devdict, t0, last, n
+
+def _process(f):
+    # brings f+'.processed' up to date, returns True if anything was added.
+    pf, sf = f+'.processed', f+'.processed.state'
+    try: st = json.load(open(sf))
+    except (IOError, ValueError): st = None
+    size = os.path.getsize(f)
+    if st is not None and (st['offset'] > size or not os.path.exists(pf) or
+            os.path.getsize(pf) != st['psize']): st = None
+    fresh = st is None
+    if fresh: st = {'offset': 0, 't0': None, 'last_t': None}
+    elif st['offset'] == size: return False
+    t0 = None if st['t0'] is None else datetime.datetime.strptime(st['t0'], _tfmt)
+    logfile = open(f, 'rb')
+    logfile.seek(st['offset'])
+    devdict, t0, t, n = _parse_lines(logfile, t0)
+    logfile.close()
+    if n == 0 and not fresh: return False
+    if len(devdict) > 0 or fresh:
         devdict1 = {}
         for k, v in devdict.iteritems():
             devdict1[k] = np.array(v)
-        pickle.dump(devdict1, open(f+'.processed', 'w+'))
+        with open(pf, 'wb' if fresh else 'ab') as out: pickle.dump(devdict1, out, 2)
+    st['offset'] += n
+    if t0 is not None: st['t0'] = t0.strftime(_tfmt)
+    if t is not None: st['last_t'] = t.strftime(_tfmt)
+    st['psize'] = os.path.getsize(pf)
+    with open(sf+'.tmp', 'w') as out: json.dump(st, out)
+    os.rename(sf+'.tmp', sf)
+    return True
+
+def _pickle_logfiles(fnames):
+    with _proc_lock:
+        return [f for f in fnames if _process(f)]
 
 # this is a wrapper for above function. Just checks all '.txt' files in
-# log directory (except logview.txt) and converts them to processed.
-# skips a file if it is already processed.
-def _procfiles():
+# log directory (except logview.txt) and brings their processed files up to
+# date. wait=False skips it if another one is running.
+def _procfiles(wait=True):
     global datadir
     txtfiles = [f for f in os.listdir(datadir) if f[-3:]=='txt']
-    procedfiles = [f for f in os.listdir(datadir) if f[-9:]=='processed']
-    for t in txtfiles:
-        if t=='logview.txt': continue
-        t1 = t+'.processed'
-        if t1 not in procedfiles: 
-            _pickle_logfiles([datadir+t])
-            print 'processed:', t1
+    if not _proc_lock.acquire(wait): return
+    try:
+        for t in txtfiles:
+            if t=='logview.txt': continue
+            if _process(datadir+t): print 'processed:', t+'.processed'
+    finally: _proc_lock.release()
+
+# loads the binary telemetry recorded by the controlserver next to a log file
+# (see controlserver/logwriter.py) without parsing it. Returns the records as
+# a numpy array with fields t, dev, cmd, value, status and the tables which
+# give the names of dev, cmd and status indices. Time is the monotonic clock
+# of the controlserver, wall_t0 is added to get unix time. The older segments
+# of a log (recorded with other tables or before a reboot) are in
+# <logfile>.tlm.1, .tlm.2, .. and are loaded the same way.
+_tlm_dtype = np.dtype([('t', '<f8'), ('dev', '<u2'), ('cmd', '<u2'), ('value', '<f4'), ('status', 'u1')])
+def load_telemetry(fname):
+    tables = json.load(open(fname+'.json'))
+    if os.path.getsize(fname) < _tlm_dtype.itemsize: return np.zeros(0, _tlm_dtype), tables
+    return np.memmap(fname, dtype=_tlm_dtype, mode='r'), tables
 
 # this runs when program loads.
-import threading
 def background_proc():
     proc_thread = threading.Thread(target=_procfiles)
     proc_thread.start()
@@ -84,12 +143,23 @@ background_proc()
 
 # this is used to load the processed files for analysis.
 # used from get_view (see below).
-_d, _fname = None, ''
+# A processed file is one or more pickled {dev: array}, see above. It is
+# loaded again when it has grown.
+_d, _fname = None, None
 def _loaddata(fname):
     global _d, _fname
-    if _d == None or _fname != fname:
-        _fname = fname
-        _d = pickle.load(open(_fname))
+    key = (fname, os.path.getsize(fname))
+    if _d == None or _fname != key:
+        chunks = []
+        with open(fname, 'rb') as fp:
+            while True:
+                try: chunks.append(pickle.load(fp))
+                except EOFError: break
+        d = {}
+        for k in set(k for c in chunks for k in c):
+            arys = [c[k] for c in chunks if k in c and len(c[k]) > 0]
+            d[k] = np.concatenate(arys) if len(arys) > 0 else np.zeros((0, 2))
+        _d, _fname = d, key
     return _d
 
 # _tail just returns last line of data. can be used to see the
@@ -117,6 +187,7 @@ def get_plotdata(data, displaylen=100, fmt='json'): # fmt can be json or python
     global datadir
     d = None
     if data['cmd']=='get_filelist':
+        _procfiles(wait=False)
         files = [f for f in os.listdir(datadir) if f[-9:]=='processed']
         data['args'] = files
         return json.dumps(data)
@@ -125,6 +196,11 @@ def get_plotdata(data, displaylen=100, fmt='json'): # fmt can be json or python
         dstr = {}
         #args[0] is filename, [1] is list of devices, [2] is plot name
         lo, hi = map(int, args['range'])
+        # the new lines of a log which is being written are added first.
+        if args['fname'][-10:] == '.processed' and os.path.exists(datadir+args['fname'][:-10]):
+            if _proc_lock.acquire(False):
+                try: _process(datadir+args['fname'][:-10])
+                finally: _proc_lock.release()
         d = _loaddata(datadir+args['fname'])
         for i in range(len(args['plots'])):
             skip = 1
@@ -0,0 +1,79 @@
+# short lived cache of the control server's replies to the bundles of reads
+# sent to /generator.
+#
+# The pages of all the open tabs send the same bundle (upd_cmdlist in
+# index.html) every update interval. A bundle having only reads is answered
+# from here if the same bundle (the same json, up to the order of the keys)
+# has been answered within the ttl of its commands. While one is on its way
+# to the control server, the same bundle from other requests waits for its
+# reply. Any other command for a device (set_flow, open, ...) empties the
+# cache, and a reply which was on its way then isn't kept, so a read after
+# a write is always sent. Replies with errors aren't kept.
+import json
+import time
+import threading
+
+def readonly(cmd): return cmd[:4] == 'get_' # same as dispatch.readonly
+
+class Cache():
+    def __init__(self, ttls, default_ttl=0.0):
+        # ttls: {cmd: seconds}, default_ttl is for the reads not in it.
+        self.ttls, self.default_ttl = ttls, default_ttl
+        self.lock, self.entries, self.pending, self.gen = threading.Lock(), {}, {}, 0
+
+    def ttl(self, d):
+        # the time a reply to d can be kept, 0 if it can't be.
+        ttl = None
+        for r in d:
+            if r.get('dev') == 'controller' or r.get('fresh', False): return 0.0
+            if not readonly(r.get('cmd', '')): return 0.0
+            t = self.ttls.get(r['cmd'], self.default_ttl)
+            ttl = t if ttl is None else min(ttl, t)
+        return ttl or 0.0
+
+    def invalidate(self):
+        with self.lock:
+            self.entries.clear()
+            self.gen += 1
+
+    def request(self, d, send):
+        # send(d) gets the reply from the control server.
+        if not isinstance(d, list): return send(d)
+        if any(r.get('dev') != 'controller' and not readonly(r.get('cmd', '')) for r in d):
+            self.invalidate()
+            try: return send(d)
+            finally: self.invalidate() # the reads sent meanwhile may be from before.
+        ttl = self.ttl(d)
+        if ttl <= 0: return send(d)
+        k = json.dumps(d, sort_keys=True)
+        with self.lock:
+            e = self.entries.get(k)
+            if e is not None and e[1] > time.time(): return e[0]
+            p = self.pending.get(k)
+            if p is None:
+                p = self.pending[k] = [threading.Event(), None]
+                gen, mine = self.gen, True
+            else: mine = False
+        if not mine:
+            p[0].wait()
+            if p[1] is not None: return p[1]
+            return send(d)
+        r = None
+        try:
+            r = send(d)
+            return r
+        finally:
+            with self.lock:
+                del self.pending[k]
+                if r is not None and gen == self.gen:
+                    # the waiting ones get the reply, even with errors.
+                    p[1] = r
+                    now = time.time()
+                    for x in [y for y, v in self.entries.iteritems() if v[1] <= now]: del self.entries[x]
+                    if self._ok(r): self.entries[k] = (r, now+ttl)
+            p[0].set()
+
+    def _ok(self, r):
+        # the sierra mfc's status is 0 (see dispatch.failed in controlserver).
+        try: return all(x.get('status') in ('OK', 0) for x in json.loads(r))
+        except (ValueError, AttributeError): return False